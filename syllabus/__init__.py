@@ -21,33 +21,35 @@
 
 import os
 import yaml
-from flask import request, has_request_context
+from flask import request, has_request_context, has_app_context, g
 from werkzeug.security import safe_join
-from sphinx.application import Sphinx
-from sphinxcontrib.websupport import WebSupport
 
 from syllabus.utils.yaml_ordered_dict import OrderedDictYAMLLoader, OrderedDumper
 
 
 def get_toc(course, force=False):
+    # imported here as the registry is only needed once the courses are served
+    from syllabus.utils.course_registry import get_course_registry
+    registry = get_course_registry()
+    # with the git snapshots, each version of the pages has its own TOC
+    key = ("toc", get_pages_path(course))
+
     def reload_toc():
         """ loads the TOC explicitely """
         # TODO: change this hack a bit ugly
         from syllabus.utils.toc import TableOfContent
-        get_toc.TOC[course] = TableOfContent(course)
-        return get_toc.TOC[course]
-
-    if force:
-        return reload_toc()
-    else:
-        # use cached version
-        try:
-            return get_toc.TOC[course]
-        except KeyError:
-            return reload_toc()
-
+        # forget the TOCs of the snapshots that have been removed
+        for cached_key in registry.get_keys(course):
+            if cached_key[0] == "toc" and cached_key != key and not os.path.isdir(cached_key[1]):
+                registry.discard(course, cached_key)
+        return TableOfContent(course)
 
-get_toc.TOC = {}
+    # the TOC is reloaded when its file is modified, e.g. by the git sync or the admin of another worker
+    try:
+        version = os.stat(os.path.join(key[1], "toc.yaml")).st_mtime_ns
+    except OSError:
+        version = None
+    return registry.get(course, key, version, reload_toc, force)
 
 
 def save_toc(course, TOC):
@@ -65,16 +67,33 @@ def get_courses():
     return get_config()['courses'].keys()
 
 
-def get_pages_path(course):
+def get_pages_path(course, resolve=True):
     """
     :return: The path to the content of the "pages" directory. if the syllabus_pages_path variable is set in config.py,
     or if the SYLLABUS_PAGES_PATH environment variable is set in a request context, the returned path will be in the
     specified value (the environment variable has the highest priority)
     If none of these is set, the path will be in the current working directory (os.cwd())
+    :param resolve: if False, the link to the active snapshot is returned instead of the snapshot itself
     """
     syllabus_pages_path = get_config()['courses'][course]['pages']['path']
     path = syllabus_pages_path if syllabus_pages_path is not None else os.getcwd()
-    return os.path.join(path, "pages")
+    pages_path = os.path.join(path, "pages")
+    if not resolve or not uses_git_snapshots(course):
+        return pages_path
+    # "pages" is a link to the snapshot of the active commit, it is resolved once per request so that a request
+    # never mixes two versions of the pages
+    if has_app_context():
+        pinned = g.setdefault("pages_paths", {})
+        if course not in pinned:
+            pinned[course] = os.path.realpath(pages_path)
+        return pinned[course]
+    return os.path.realpath(pages_path)
+
+
+def uses_git_snapshots(course):
+    """ :return: True if the pages of the course are served from immutable snapshots of their git repository """
+    git_sync_config = get_config().get("git_sync", None) or {}
+    return bool(git_sync_config.get("snapshots", False)) and "git" in get_config()['courses'][course]['pages']
 
 
 def get_pages_cache_path(course):
@@ -100,8 +119,12 @@ def get_config(force=False):
 
 
 def get_sphinx_build(course, force=False):
+    from syllabus.utils.course_registry import get_course_registry
+    config = get_config()['courses'][course]['sphinx']
+
     def reload_support():
-        config = get_config()['courses'][course]['sphinx']
+        # sphinx is only imported by the workers serving a Sphinx course
+        from sphinx.application import Sphinx
 
         # The build dir is created by the Sphinx call. Thus if we need to compile the pages, checking after
         # if the build dir exists would always yield True.
@@ -113,17 +136,12 @@ def get_sphinx_build(course, force=False):
             app.add_directive(directive_name, directive_class)
         if force or not build_dir_exists:
             app.build(False, [])
-        if not hasattr(get_sphinx_build, "cached"):
-            get_sphinx_build.cached = {}
-        get_sphinx_build.cached[course] = app
+            from syllabus.utils.assets import precompress_directory
+            precompress_directory(app.builder.outdir)
+        return app
 
-        return get_sphinx_build.cached[course]
-    if force:
-        return reload_support()
-    try:
-        return get_sphinx_build.cached[course]
-    except (AttributeError, KeyError):
-        return reload_support()
+    return get_course_registry().get(course, ("sphinx", os.path.abspath(config['build_dir'])), None, reload_support,
+                                     force)
 
 
 def get_config_path():
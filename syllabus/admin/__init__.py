@@ -1,3 +1,5 @@
+import csv
+import io
 import shutil
 from functools import wraps
 
@@ -6,18 +8,25 @@ import os
 import re
 import yaml
 
-from syllabus.database import db_session
+from syllabus.database import db_session, database_stats
+from syllabus.utils.course_registry import get_course_registry
 from syllabus.models.params import Params
 from syllabus.utils.feedbacks import *
+from syllabus.utils.git_sync import get_sync_scheduler, get_active_snapshot
 from syllabus.utils.toc import TableOfContent, ContentNotFoundError, Page, Chapter
 from syllabus.utils.yaml_ordered_dict import OrderedDictYAMLLoader
 
 import syllabus
-from flask import Blueprint, render_template, abort, request, session
+from flask import Blueprint, render_template, abort, request, session, jsonify, make_response, g
+from sqlalchemy import or_, and_, func
 from jinja2 import TemplateNotFound
 
 from syllabus.models.user import User
-from syllabus.utils.pages import permission_admin, seeother
+from syllabus.utils.inginious_client import get_inginious_client, get_circuit_breaker
+from syllabus.utils.mail_queue import get_mail_queue
+from syllabus.utils.pages import permission_admin, seeother, invalidate_user_right
+from syllabus.utils.password_hashing import get_password_hasher, PasswordHashingRefused
+from syllabus.utils.user_import import import_users, parse_users_csv, write_reset_links
 
 admin_blueprint = Blueprint('admin', __name__,
                             template_folder='templates',
@@ -30,6 +39,8 @@ sidebar_elements = [{'id': 'users', 'name': 'Users', 'icon': 'users'}] + \
 
 sidebar = {'active_element': 'users', 'elements': sidebar_elements}
 
+users_per_page = 50
+
 
 def sidebar_page(element):
     def decorator(f):
@@ -54,16 +65,91 @@ def users():
             if inpt["rights"] in ["admin", "teacher", ""]:
                 user.right = None if inpt['rights'] == '' else inpt['rights']
                 db_session.commit()
+                invalidate_user_right(user.email)
                 return seeother(request.path, SuccessFeedback("The rights of %s have been successfully edited" % user.email))
         return seeother(request.path)
+    search = request.args.get("q", "")
+    users_page, has_previous, has_next = get_users_page(search, after=request.args.get("after", None),
+                                                        before=request.args.get("before", None))
     try:
         return render_template('users.html', active_element=sidebar['active_element'],
-                               sidebar_elements=sidebar['elements'], users=User.query.all(),
+                               sidebar_elements=sidebar['elements'], users=users_page, search=search,
+                               has_previous=has_previous, has_next=has_next,
                                feedback=pop_feeback(session))
     except TemplateNotFound:
         abort(404)
 
 
+@admin_blueprint.route('/users/import', methods=['POST'])
+@permission_admin
+def users_import():
+    """
+    Imports the users of the uploaded CSV file. If some of them have no password, the CSV file of their password reset
+    links is returned.
+    """
+    uploaded = request.files.get("users_csv", None)
+    if uploaded is None or uploaded.filename == "":
+        return seeother("/admin/users", ErrorFeedback("No CSV file was uploaded."))
+    try:
+        report = import_users(parse_users_csv(io.TextIOWrapper(uploaded.stream, encoding="utf-8-sig", newline="")))
+    except (ValueError, csv.Error) as e:
+        return seeother("/admin/users", ErrorFeedback("Could not read the CSV file: %s" % e))
+    except PasswordHashingRefused as e:
+        return seeother("/admin/users", ErrorFeedback(str(e)))
+    message = "%d users imported, %d already existing, %d invalid rows." % (report["imported"], len(report["existing"]),
+                                                                           len(report["invalid"]))
+    if not report["change_password_urls"]:
+        return seeother("/admin/users", SuccessFeedback(message))
+    reset_links = io.StringIO()
+    write_reset_links(report, reset_links, base_url=request.host_url)
+    response = make_response(reset_links.getvalue())
+    response.headers["Content-Type"] = "text/csv"
+    response.headers["Content-Disposition"] = "attachment; filename=reset_links.csv"
+    return response
+
+
+@admin_blueprint.route('/users/data', methods=['GET'])
+@permission_admin
+def users_data():
+    """
+    Returns a page of the users matching the q prefix, after or before the given e-mails. The previous and next
+    fields contain the e-mails to use as before and after parameters to get the adjacent pages.
+    """
+    try:
+        limit = min(max(int(request.args.get("limit", users_per_page)), 1), 500)
+    except ValueError:
+        abort(400)
+    users_page, has_previous, has_next = get_users_page(request.args.get("q", ""), after=request.args.get("after", None),
+                                                        before=request.args.get("before", None), limit=limit)
+    return jsonify({"users": [{"email": u.email, "full_name": u.full_name, "right": u.right} for u in users_page],
+                    "previous": users_page[0].email if has_previous and users_page else None,
+                    "next": users_page[-1].email if has_next and users_page else None})
+
+
+def get_users_page(search, after=None, before=None, limit=users_per_page):
+    """
+    Keyset pagination of the users ordered by e-mail: only the requested page is read, whatever the number of users.
+    :param search: a case-insensitive prefix of the e-mail or the full name of the users
+    :param after: the e-mail after which the page starts
+    :param before: the e-mail before which the page ends, ignored if after is given
+    :return: a (users, has_previous, has_next) tuple
+    """
+    query = User.query
+    if search:
+        # prefix range, it uses the ix_users_email_lower and ix_users_full_name_lower indexes
+        prefix = search.lower()
+        prefix_end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        query = query.filter(or_(and_(func.lower(User.email) >= prefix, func.lower(User.email) < prefix_end),
+                                 and_(func.lower(User.full_name) >= prefix, func.lower(User.full_name) < prefix_end)))
+    if before is not None and after is None:
+        users_page = query.filter(User.email < before).order_by(User.email.desc()).limit(limit + 1).all()
+        return users_page[:limit][::-1], len(users_page) > limit, True
+    if after is not None:
+        query = query.filter(User.email > after)
+    users_page = query.order_by(User.email).limit(limit + 1).all()
+    return users_page[:limit], after is not None, len(users_page) > limit
+
+
 @admin_blueprint.route('/content_edition/<string:course>', methods=['GET', 'POST'])
 @permission_admin
 @sidebar_page('content_edition')
@@ -75,7 +161,7 @@ def content_edition(course):
         if request.method == "POST":
             inpt = request.form
             if inpt["action"] == "sphinx_rebuild":
-                session["course"] = course
+                g.course = course
                 return sphinx_rebuild(course, course_config)
             return seeother(request.path)
         try:
@@ -299,3 +385,48 @@ def config_edition():
                                        feedback=pop_feeback(session))
         except TemplateNotFound:
             abort(404)
+
+
+@admin_blueprint.route('/monitoring/inginious', methods=['GET'])
+@permission_admin
+def inginious_monitoring():
+    """ Returns the counters of the INGInious client and the state of the circuit breakers of this worker. """
+    return jsonify({"requests": get_inginious_client().get_stats(),
+                    "circuit_breakers": {course: get_circuit_breaker(course).to_dict() for course in syllabus.get_courses()}})
+
+
+@admin_blueprint.route('/monitoring/password_hashing', methods=['GET'])
+@permission_admin
+def password_hashing_monitoring():
+    """ Returns the counters of the password hasher of this worker. """
+    return jsonify(get_password_hasher().get_stats())
+
+
+@admin_blueprint.route('/monitoring/mail_queue', methods=['GET'])
+@permission_admin
+def mail_queue_monitoring():
+    """ Returns the number of pending and failed e-mails of the mail queue. """
+    return jsonify(get_mail_queue().get_stats())
+
+
+@admin_blueprint.route('/monitoring/git_sync', methods=['GET'])
+@permission_admin
+def git_sync_monitoring():
+    """ Returns the counters of the background syncs of the git courses in this worker. """
+    return jsonify({course: dict(get_sync_scheduler(course).get_stats(), active_snapshot=get_active_snapshot(course))
+                    for course in syllabus.get_courses()
+                    if "git" in syllabus.get_config()["courses"][course].get("pages", {})})
+
+
+@admin_blueprint.route('/monitoring/courses', methods=['GET'])
+@permission_admin
+def courses_monitoring():
+    """ Returns the memory footprint of the courses resident in this worker and the evictions of the registry. """
+    return jsonify(get_course_registry().get_stats())
+
+
+@admin_blueprint.route('/monitoring/database', methods=['GET'])
+@permission_admin
+def database_monitoring():
+    """ Returns the connection pool and statement counters of the database of this worker. """
+    return jsonify(database_stats.get_stats())
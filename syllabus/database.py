@@ -3,9 +3,11 @@ import os
 import binascii
 import re
 import stat
+import threading
+import time
 from operator import or_
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, event
 from sqlalchemy.engine import ResultProxy
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -13,14 +15,112 @@ from syllabus import get_root_path
 from syllabus import get_config
 
 database_uri = os.environ.get("SYLLABUS_DATABASE_URI", 'sqlite:///%s' % os.path.join(get_root_path(), 'database.sqlite'))
-engine = create_engine(database_uri)
+
+
+def get_database_config():
+    database_config = get_config().get("database", None) or {}
+    sqlite_config = database_config.get("sqlite", None) or {}
+    return {
+        "pool_size": database_config.get("pool_size", 5),
+        "max_overflow": database_config.get("max_overflow", 10),
+        "pool_timeout": database_config.get("pool_timeout", 30),
+        "pool_recycle": database_config.get("pool_recycle", -1),
+        "journal_mode": sqlite_config.get("journal_mode", "WAL"),
+        "synchronous": sqlite_config.get("synchronous", "NORMAL"),
+        "busy_timeout": sqlite_config.get("busy_timeout", 5000),
+    }
+
+
+class DatabaseStats(object):
+    """
+    Counters of the connection pool and of the time spent in the statements of this process. With SQLite, the time
+    spent in the writing statements is mostly the time spent waiting for the database lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, counter, value=1):
+        with self._lock:
+            self._stats[counter] = self._stats.get(counter, 0) + value
+
+    def record_max(self, counter, value):
+        with self._lock:
+            self._stats[counter] = max(self._stats.get(counter, 0), value)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        pool = engine.pool
+        for name in ["size", "checkedout", "overflow", "checkedin"]:
+            if hasattr(pool, name):
+                stats["pool_" + name] = getattr(pool, name)()
+        return stats
+
+
+database_stats = DatabaseStats()
+
+
+def _create_engine(uri):
+    database_config = get_database_config()
+    kwargs = {}
+    if not (uri in ["sqlite://", "sqlite:///"] or (uri.startswith("sqlite") and ":memory:" in uri)):
+        # the in-memory SQLite databases use a single connection per thread
+        kwargs = {"pool_size": database_config["pool_size"], "max_overflow": database_config["max_overflow"],
+                  "pool_timeout": database_config["pool_timeout"], "pool_recycle": database_config["pool_recycle"]}
+    new_engine = create_engine(uri, **kwargs)
+
+    @event.listens_for(new_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        database_stats.record("connections_opened")
+        if new_engine.dialect.name != "sqlite":
+            return
+        # several processes write in the database, WAL lets them read while another one is writing
+        cursor = dbapi_connection.cursor()
+        if database_config["journal_mode"]:
+            cursor.execute("PRAGMA journal_mode=%s" % database_config["journal_mode"])
+        if database_config["synchronous"]:
+            cursor.execute("PRAGMA synchronous=%s" % database_config["synchronous"])
+        cursor.execute("PRAGMA busy_timeout=%d" % int(database_config["busy_timeout"]))
+        cursor.close()
+
+    @event.listens_for(new_engine, "checkout")
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        database_stats.record("checkouts")
+        if hasattr(new_engine.pool, "checkedout"):
+            database_stats.record_max("max_checkedout", new_engine.pool.checkedout())
+
+    @event.listens_for(new_engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.monotonic())
+
+    @event.listens_for(new_engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        duration = time.monotonic() - conn.info["statement_start"].pop()
+        kind = "write" if statement.lstrip()[:6].upper() in ["INSERT", "UPDATE", "DELETE"] else "read"
+        database_stats.record("%s_statements" % kind)
+        database_stats.record("%s_time_total" % kind, duration)
+        database_stats.record_max("%s_time_max" % kind, duration)
+
+    @event.listens_for(new_engine, "handle_error")
+    def count_errors(context):
+        database_stats.record("errors")
+        if "database is locked" in str(context.original_exception):
+            database_stats.record("lock_timeouts")
+        if context.connection is not None and context.connection.info.get("statement_start"):
+            context.connection.info["statement_start"].pop()
+
+    return new_engine
+
+
+engine = _create_engine(database_uri)
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
-current_version = 4
+current_version = 5
 
 
 def create_db_user():
@@ -78,79 +178,123 @@ def reload_database():
                                              bind=engine))
 
 
+# the schema migrations, as (version, description, function) tuples. The function receives a DBAPI cursor.
+migrations = []
+
+
+def migration(version, description):
+    """ Registers the decorated function as the migration of the database to the given version. """
+    def decorator(f):
+        migrations.append((version, description, f))
+        return f
+    return decorator
+
+
+@migration(1, "add the right of the users")
+def _add_users_right(cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN right STRING(30);")
+
+
+@migration(2, "add the params table")
+def _add_params(cursor):
+    cursor.execute("""
+    CREATE TABLE params(
+       git_hook_url STRING(80),
+       id           INTEGER PRIMARY KEY
+    );
+    """)
+    cursor.execute("INSERT INTO params (git_hook_url, id) VALUES (NULL, 1);")
+
+
+@migration(3, "add the activation of the users")
+def _add_users_activated(cursor):
+    cursor.execute("ALTER TABLE users RENAME TO users_old")
+    cursor.execute("DROP INDEX ix_users_username")
+    cursor.execute("""
+    CREATE TABLE users (
+        username VARCHAR(40) PRIMARY KEY NOT NULL,
+        email VARCHAR(120) UNIQUE NOT NULL,
+        full_name VARCHAR(50),
+        hash_password VARCHAR(80),
+        change_password_url VARCHAR(50),
+        "right" VARCHAR(30),
+        activated BOOLEAN NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX ix_users_username ON users (username)")
+    # the existing users are activated
+    cursor.execute('INSERT INTO users (username, email, full_name, hash_password, change_password_url, "right", activated) '
+                   'SELECT username, email, full_name, hash_password, change_password_url, "right", 1 FROM users_old')
+    cursor.execute("DROP TABLE users_old")
+
+
+@migration(4, "identify the users by their e-mail")
+def _identify_users_by_email(cursor):
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    from syllabus.models.user import User
+    cursor.execute("ALTER TABLE users RENAME TO users_old")
+    cursor.execute("DROP INDEX ix_users_username")
+    cursor.execute(str(CreateTable(User.__table__).compile(engine)))
+    for idx in User.__table__.indexes:
+        cursor.execute(str(CreateIndex(idx).compile(engine)))
+    cursor.execute('INSERT INTO users (email, full_name, hash_password, change_password_url, "right", activated) '
+                   'SELECT email, full_name, hash_password, change_password_url, "right", activated FROM users_old')
+    cursor.execute("DROP TABLE users_old")
+
+
+@migration(5, "index the lowercase e-mails and names of the users")
+def _index_users_search(cursor):
+    # these indexes are already created by version 4 when it is applied at the same time
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_full_name_lower ON users (lower(full_name))")
+
+
 def update_database():
+    """
+    Applies the missing migrations to the SQLite database. They are all applied in a single transaction: if one of
+    them fails, the database is left untouched. The applied migrations are recorded in the schema_migrations table.
+    """
     if "sqlite" not in database_uri:
         return
     database_path = database_uri.replace("sqlite://", "")
-    if os.path.isfile(database_path):
-        connection = engine.connect()
-        version = connection.execute(text("PRAGMA main.user_version;")).first()[0]
-        if version < current_version:
-            print("database version (%d) is outdated, updating database to version %d" % (version, current_version))
-        if version < 1:
-            print("updating to version 1")
-            connection.execute(text("ALTER TABLE users ADD COLUMN right STRING(30);"))
-        if version < 2:
-            print("updating to version 2")
-            connection.execute(text("""
-            CREATE TABLE params(
-               git_hook_url STRING(80),
-               id           INTEGER PRIMARY KEY
-            );
-            """))
-            connection.execute(text("""
-            INSERT INTO params (git_hook_url, id)
-            VALUES (NULL, 1);
-            """))
-        if version < 3:
-            print("updating to version 3")
-            # Rename users to users_old and drop index
-            connection.execute(text("ALTER TABLE users RENAME TO users_old"))
-            connection.execute(text("DROP INDEX ix_users_username"))
-
-            connection.execute(text("""
-            CREATE TABLE users (
-                username VARCHAR(40) PRIMARY KEY NOT NULL,
-                email VARCHAR(120) UNIQUE NOT NULL,
-                full_name VARCHAR(50),
-                hash_password VARCHAR(80),
-                change_password_url VARCHAR(50),
-                "right" VARCHAR(30),
-                activated BOOLEAN NOT NULL
-            );
-            """))
-            connection.execute(text("CREATE INDEX ix_users_username ON users (username)"))
-
-            for row in connection.execute(text("SELECT username, email, full_name, hash_password, change_password_url, "
-                                          "right FROM users_old")):
-                connection.execute(text("INSERT INTO users (username, email, full_name, hash_password, change_password_url, right, activated) "
-                                   "VALUES ('{}', '{}', {}, '{}', {}, {}, {})".format(row[0], row[1], "NULL" if row[2] is None else "'%s'" % row[2],
-                                                                                      row[3], "NULL" if row[4] is None else "'%s'" % row[4],
-                                                                                      "NULL" if row[5] is None else "'%s'" % row[5], 1)))
-            connection.execute(text("DROP TABLE users_old"))
-        if version < 4:
-            print("updating to version 4")
-            from sqlalchemy.schema import CreateTable, CreateIndex
-            from syllabus.models.user import User
-            connection.execute(text("ALTER TABLE users RENAME TO users_old"))
-            connection.execute(text("DROP INDEX ix_users_username"))
-            connection.execute(CreateTable(User.__table__))
-            for idx in User.__table__.indexes:
-                connection.execute(CreateIndex(idx))
-            for row in connection.execute(text("SELECT username, email, full_name, hash_password, change_password_url, "
-                                          "right, activated FROM users_old")):
-                connection.execute(text("INSERT INTO users (email, full_name, hash_password, change_password_url, right, activated) "\
-                                       "VALUES ('{}', {}, {}, {}, {}, {})".format(row[1],
-                                                                                  "null" if row[2] is None else "'%s'" % row[2],
-                                                                                  "null" if row[3] is None else "'%s'" % row[3],
-                                                                                  "null" if row[4] is None else "'%s'" % row[4],
-                                                                                  "null" if row[5] is None else "'%s'" % row[5],
-                                                                                  row[6])))
-            connection.execute(text("DROP TABLE users_old"))
-
-        connection.execute(text("PRAGMA main.user_version=%d;" % current_version))
-    else:
+    if not os.path.isfile(database_path):
         print("The database does not exist yet.")
+        return
+    connection = engine.raw_connection()
+    dbapi_connection = None
+    try:
+        dbapi_connection = connection.driver_connection
+        # let us control the transaction: by default, sqlite3 does not include the DDL statements in the transactions
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        version = cursor.execute("PRAGMA main.user_version;").fetchone()[0]
+        pending = sorted(m for m in migrations if m[0] > version)
+        if not pending:
+            return
+        print("database version (%d) is outdated, updating database to version %d" % (version, current_version))
+        start = time.monotonic()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, "
+                           "description TEXT, applied_at REAL NOT NULL, duration REAL NOT NULL)")
+            for migration_version, description, f in pending:
+                migration_start = time.monotonic()
+                f(cursor)
+                duration = time.monotonic() - migration_start
+                cursor.execute("INSERT OR REPLACE INTO schema_migrations (version, description, applied_at, duration) "
+                               "VALUES (?, ?, ?, ?)", (migration_version, description, time.time(), duration))
+                print("updated to version %d (%s) in %.3fs" % (migration_version, description, duration))
+            cursor.execute("PRAGMA main.user_version=%d;" % current_version)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            print("the update of the database failed, it has been left at version %d" % version)
+            raise
+        print("database updated in %.3fs" % (time.monotonic() - start))
+    finally:
+        if dbapi_connection is not None:
+            dbapi_connection.isolation_level = ""
+        connection.close()
 
 
 # we cannot register locally if either somebody has the same e-mail
@@ -19,17 +19,15 @@
 import datetime
 import os
 import re
-import urllib
-from urllib import parse
-from urllib import request as urllib_request
+import threading
+import urllib.parse
 
 from docutils.core import publish_string
 from docutils.parsers.rst import directives
 from flask import Flask, render_template, request, abort, make_response, session, redirect, \
-    send_from_directory, url_for, render_template_string
+    url_for, render_template_string, g, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import safe_join
-from onelogin.saml2.errors import OneLogin_Saml2_Error
-from onelogin.saml2.utils import OneLogin_Saml2_Utils
 from sqlalchemy.orm.exc import NoResultFound
 
 import syllabus
@@ -38,12 +36,18 @@ import syllabus.utils.pages
 from syllabus.admin import admin_blueprint, pop_feeback, set_feedback, ErrorFeedback, SuccessFeedback
 from syllabus.database import init_db, db_session, update_database, locally_register_new_user
 from syllabus.models.params import Params
-from syllabus.models.user import hash_password_func, User, UserAlreadyExists, verify_activation_mac, get_activation_mac
-from syllabus.saml import prepare_request, init_saml_auth
+from syllabus.models.user import User, UserAlreadyExists, verify_activation_mac, get_activation_mac
+from syllabus.saml import prepare_request, init_saml_auth, get_alternative_saml_settings, get_sp_metadata
+from syllabus.utils.assets import send_asset, fingerprinted_url
+from syllabus.utils.git_sync import get_sync_scheduler
+from syllabus.utils.inginious_client import get_inginious_client, get_inginious_sandbox_url, INGIniousError
 from syllabus.utils.inginious_lti import get_lti_data, get_lti_submission
-from syllabus.utils.mail import send_confirmation_mail, send_authenticated_confirmation_mail
+from syllabus.utils.mail_queue import queue_confirmation_mail, start_background_sender
+from syllabus.utils.password_hashing import hash_password, record_failed_attempt, PasswordHashingRefused
+from syllabus.utils.sessions import ServerSideSessionInterface, get_session_store, get_sessions_config
 from syllabus.utils.pages import seeother, get_content_data, permission_admin, update_last_visited, store_last_visited, render_content, default_rst_opts, get_cheat_sheet
 from syllabus.utils.toc import Content, Chapter, TableOfContent, ContentNotFoundError, Page
+from syllabus.utils.warmup import ensure_warm, get_warmup_config
 
 app = Flask(__name__, template_folder=os.path.join(syllabus.get_root_path(), 'templates'),
             static_folder=os.path.join(syllabus.get_root_path(), 'static'))
@@ -54,6 +58,27 @@ session_sk = syllabus.get_config().get("sessions_secret_key", None)
 if session_sk is None or session_sk == "":
     raise Exception("You must give a session secret key to use the application")
 app.secret_key = session_sk
+if get_sessions_config()["backend"] is not None:
+    app.session_interface = ServerSideSessionInterface(get_session_store(), get_sessions_config()["ttl"])
+app.jinja_env.globals.update(asset_url=fingerprinted_url)
+# behind a reverse proxy, the address of the client is taken from the X-Forwarded-For header set by the proxy
+reverse_proxy_config = syllabus.get_config().get("reverse_proxy", None) or {}
+if reverse_proxy_config.get("trusted_proxies", 0):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=reverse_proxy_config["trusted_proxies"],
+                            x_proto=reverse_proxy_config["trusted_proxies"])
+
+
+@app.before_request
+def start_mail_sender():
+    # the e-mails left in the queue by a restart are sent without waiting for a new registration in this worker
+    start_background_sender()
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    # give the connection back to the pool at the end of each request
+    db_session.remove()
+
 directives.register_directive('inginious', syllabus.utils.directives.InginiousDirective)
 directives.register_directive('inginious-sandbox', syllabus.utils.directives.InginiousSandboxDirective)
 directives.register_directive('table-of-contents', syllabus.utils.directives.ToCDirective)
@@ -80,7 +105,7 @@ def index(print=False):
 def course_index(course, print_mode=False):
     if not course in syllabus.get_config()["courses"].keys():
         abort(404)
-    session["course"] = course
+    g.course = course
     course_config = syllabus.get_config()["courses"][course]
     if course_config.get("sphinx"):
         return seeother("/syllabus/{}/{}".format(course, course_config["sphinx"].get("index_page", "index.html")))
@@ -95,6 +120,14 @@ def course_index(course, print_mode=False):
         abort(404)
 
 
+def send_static_file(filename):
+    return send_asset(app.static_folder, filename)
+
+
+# serve the static files like the course assets, to benefit from the fingerprinting and the file offload
+app.view_functions["static"] = send_static_file
+
+
 @app.route('/favicon.ico')
 def favicon():
     abort(404)
@@ -104,12 +137,12 @@ def favicon():
 def get_syllabus_content(course, content_path: str, print_mode=False):
     if not course in syllabus.get_config()["courses"].keys():
         abort(404)
+    g.course = course
     course_config = syllabus.get_config()["courses"][course]
     if course_config["sphinx"]:
         return render_sphinx_page(course, content_path)
     else:
         store_last_visited()
-        session["course"] = course
         if content_path[-1] == "/":
             content_path = content_path[:-1]
         TOC = syllabus.get_toc(course)
@@ -137,18 +170,16 @@ def get_syllabus_content(course, content_path: str, print_mode=False):
 def get_syllabus_asset(course, asset_path: str, content_path: str = None):
     if not course in syllabus.get_config()["courses"].keys():
         abort(404)
-    session["course"] = course
     TOC = syllabus.get_toc(course)
     if content_path is None:
-        return send_from_directory(TOC.get_global_asset_directory(), asset_path)
+        return send_asset(TOC.get_global_asset_directory(), asset_path)
     if content_path[-1] == "/":
         content_path = content_path[:-1]
     try:
         # explicitly check that the chapter exists
         chapter = TOC.get_chapter_from_path(content_path)
-        # secured way to serve a static file
-        # TODO: use X-Sendfile with this method to be efficient
-        return send_from_directory(TOC.get_asset_directory(chapter), asset_path)
+        # secured way to serve a static file, the transfer can be offloaded to the front-end server
+        return send_asset(TOC.get_asset_directory(chapter), asset_path)
     except ContentNotFoundError:
         abort(404)
 
@@ -156,6 +187,7 @@ def get_syllabus_asset(course, asset_path: str, content_path: str = None):
 @app.route('/preview/<string:course>/refresh', methods=["POST"])
 @permission_admin
 def refresh(course):
+    g.course = course
     TOC = syllabus.get_toc(course)
     data = request.form['content']
     config = syllabus.get_config()
@@ -168,7 +200,7 @@ def refresh(course):
                                  logged_in=session.get("user", None),
                                  inginious_sandbox_url=inginious_sandbox_url,
                                  inginious_course_url=inginious_course_url if not same_origin_proxy else ("/postinginious/" + course),
-                                 inginious_url=inginious_config['url'], this_content=data,
+                                 inginious_url=inginious_config['url'], this_content=data, print_mode=False,
                                  render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, **kwargs),
                                  course_str=course,
                                  courses_titles={course: config["courses"][course]["title"] for course in syllabus.get_courses()},
@@ -212,18 +244,15 @@ def edit_content(course, content_path, TOC: TableOfContent):
 def print_all_syllabus(course):
     if not course in syllabus.get_config()["courses"].keys():
         abort(404)
-    session["course"] = course
+    g.course = course
     TOC = syllabus.get_toc(course)
-    session["print_mode"] = True
-
-    retval = render_template("print_multiple_contents.html", contents=TOC,
-                             render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, **kwargs),
-                             toc=TOC, get_lti_data=get_lti_data,
-                             get_lti_submission=get_lti_submission, logged_in=session.get("user", None),
-                             course_str=course,
-                             render_rst_str=syllabus.utils.pages.render_rst_str)
-    session["print_mode"] = False
-    return retval
+    syllabus.utils.pages.prefetch_submissions(course, TOC, print_mode=True)
+    return render_template("print_multiple_contents.html", contents=TOC,
+                           render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, print_mode=True, **kwargs),
+                           toc=TOC, get_lti_data=get_lti_data,
+                           get_lti_submission=get_lti_submission, logged_in=session.get("user", None),
+                           course_str=course,
+                           render_rst_str=syllabus.utils.pages.render_rst_str)
 
 
 def get_chapter_printable_content(course: str, chapter: Chapter, toc: TableOfContent):
@@ -237,65 +266,51 @@ def get_chapter_printable_content(course: str, chapter: Chapter, toc: TableOfCon
                 printable_content.append(content)
         return printable_content
 
-    session["print_mode"] = True
-    try:
-        retval = render_template("print_multiple_contents.html", contents=fetch_content(chapter), logged_in=session.get("user", None),
-                                 render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, **kwargs),
-                                 toc=TOC,
-                                 course_str=course,
-                                 get_lti_submission=get_lti_submission)
-        session["print_mode"] = False
-        return retval
-    except:
-        session["print_mode"] = False
-        raise
+    printable_content = fetch_content(chapter)
+    syllabus.utils.pages.prefetch_submissions(course, printable_content, print_mode=True)
+    return render_template("print_multiple_contents.html", contents=printable_content, logged_in=session.get("user", None),
+                           render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, print_mode=True, **kwargs),
+                           toc=TOC,
+                           course_str=course,
+                           get_lti_submission=get_lti_submission)
 
 
 def render_web_page(course: str, content: Content, print_mode=False, display_print_all=False):
+    TOC = syllabus.get_toc(course)
     try:
-        TOC = syllabus.get_toc(course)
-        session["print_mode"] = print_mode
-        try:
-            previous = TOC.get_previous_content(content)
-        except KeyError:
-            previous = None
-        try:
-            next = TOC.get_next_content(content)
-        except KeyError:
-            next = None
-
-        config = syllabus.get_config()
-        inginious_config = config['courses'][course]['inginious']
-        inginious_course_url = "%s/%s" % (inginious_config['url'], inginious_config['course_id'])
-        path = safe_join(inginious_config.get("simple_grader_pattern", "/"), inginious_config['course_id'])
-        inginious_sandbox_url = urllib.parse.urljoin(inginious_config["url"], path)
-        same_origin_proxy = inginious_config['same_origin_proxy']
-        retval = render_template('rst_page.html' if not print_mode else 'print_page.html',
-                                 logged_in=session.get("user", None),
-                                 inginious_config = syllabus.get_config()['courses'][course]['inginious'],
-                                 inginious_course_url=inginious_course_url if not same_origin_proxy else ("/postinginious/" + course),
-                                 inginious_sandbox_url=inginious_sandbox_url,
-                                 inginious_url=inginious_config['url'],
-                                 containing_chapters=TOC.get_containing_chapters_of(content), this_content=content,
-                                 render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, **kwargs),
-                                 render_footer= lambda course: syllabus.utils.pages.render_footer(course),
-                                 content_at_same_level=TOC.get_content_at_same_level(content),
-                                 course_str=course,
-                                 courses_titles={course: config["courses"][course]["title"] for course in syllabus.get_courses()},
-                                 toc=TOC,
-                                 direct_content=TOC.get_direct_content_of(content), next=next, previous=previous,
-                                 display_print_all=display_print_all,
-                                 get_lti_data=get_lti_data, get_lti_submission=get_lti_submission,
-                                 render_rst_str=syllabus.utils.pages.render_rst_str,
-                                 login_img="/static/login.png" if os.path.exists(os.path.join(app.static_folder, "login.png")) else None,
-                                 auth_methods=syllabus.get_config()["authentication_methods"])
+        previous = TOC.get_previous_content(content)
+    except KeyError:
+        previous = None
+    try:
+        next = TOC.get_next_content(content)
+    except KeyError:
+        next = None
 
-        session["print_mode"] = False
-    except Exception:
-        # ensure that the print mode is disabled
-        session["print_mode"] = False
-        raise
-    return retval
+    config = syllabus.get_config()
+    inginious_config = config['courses'][course]['inginious']
+    inginious_course_url = "%s/%s" % (inginious_config['url'], inginious_config['course_id'])
+    path = safe_join(inginious_config.get("simple_grader_pattern", "/"), inginious_config['course_id'])
+    inginious_sandbox_url = urllib.parse.urljoin(inginious_config["url"], path)
+    same_origin_proxy = inginious_config['same_origin_proxy']
+    return render_template('rst_page.html' if not print_mode else 'print_page.html',
+                           logged_in=session.get("user", None),
+                           inginious_config = syllabus.get_config()['courses'][course]['inginious'],
+                           inginious_course_url=inginious_course_url if not same_origin_proxy else ("/postinginious/" + course),
+                           inginious_sandbox_url=inginious_sandbox_url,
+                           inginious_url=inginious_config['url'],
+                           containing_chapters=TOC.get_containing_chapters_of(content), this_content=content,
+                           render_rst=lambda content, **kwargs: syllabus.utils.pages.render_content(course, content, print_mode=print_mode, **kwargs),
+                           render_footer= lambda course: syllabus.utils.pages.render_footer(course),
+                           content_at_same_level=TOC.get_content_at_same_level(content),
+                           course_str=course,
+                           courses_titles={course: config["courses"][course]["title"] for course in syllabus.get_courses()},
+                           toc=TOC,
+                           direct_content=TOC.get_direct_content_of(content), next=next, previous=previous,
+                           display_print_all=display_print_all,
+                           get_lti_data=get_lti_data, get_lti_submission=get_lti_submission,
+                           render_rst_str=syllabus.utils.pages.render_rst_str,
+                           login_img="/static/login.png" if os.path.exists(os.path.join(app.static_folder, "login.png")) else None,
+                           auth_methods=syllabus.get_config()["authentication_methods"])
 
 def render_sphinx_page(course: str, docname: str):
     build = syllabus.get_sphinx_build(course)
@@ -319,12 +334,12 @@ def render_sphinx_page(course: str, docname: str):
                                                          syllabus.get_courses()},
                                          inginious_config=inginious_config,
                                          inginious_url=inginious_config['url'],
-                                         course_str=course,
+                                         course_str=course, print_mode=False,
                                          get_lti_data=get_lti_data, get_lti_submission=get_lti_submission,
                                          login_img="/static/login.png" if config['courses'][course].get("use_logged_out_img", False) else None)
         except FileNotFoundError:
             abort(404)
-    return send_from_directory(build.builder.outdir, docname)
+    return send_asset(build.builder.outdir, docname)
 
 
 
@@ -342,9 +357,12 @@ def reset_password(secret):
         password_confirm = inpt["password_confirm"]
         if password != password_confirm:
             return render_template("reset_password.html", alert_hidden=False)
-        password_hash = hash_password_func(email=user.email, password=password,
-                                           global_salt=syllabus.get_config().get('password_salt', None),
-                                           n_iterations=syllabus.get_config().get('password_hash_iterations', 100000))
+        try:
+            password_hash = hash_password(user.email, password, client_ip=request.remote_addr)
+        except PasswordHashingRefused as e:
+            response = make_response(str(e), 503)
+            response.headers['Retry-After'] = '10'
+            return response
         user.hash_password = password_hash
         user.change_password_url = None
         db_session.commit()
@@ -363,15 +381,17 @@ def log_in():
         email = inpt["email"]
         password = inpt["password"]
         try:
-            password_hash = hash_password_func(email=email, password=password,
-                                               global_salt=syllabus.get_config().get('password_salt', None),
-                                               n_iterations=syllabus.get_config().get('password_hash_iterations', 100000))
+            password_hash = hash_password(email, password, client_ip=request.remote_addr)
         except UnicodeEncodeError:
             # TODO: log
             return seeother("/login")
+        except PasswordHashingRefused as e:
+            set_feedback(session, ErrorFeedback(str(e)), feedback_type="login")
+            return seeother("/login")
 
         user = User.query.filter(User.email == email).first()
         if user is None or user.hash_password != password_hash:
+            record_failed_attempt(request.remote_addr, email)
             set_feedback(session, ErrorFeedback("Invalid email/password."), feedback_type="login")
             return seeother("/login")
         if not user.activated:
@@ -387,6 +407,7 @@ def log_out():
         saml = session["user"].get("login_method", None) == "saml"
         session.pop("user", None)
         if saml and "singleLogoutService" in saml_config["sp"]:
+            from onelogin.saml2.errors import OneLogin_Saml2_Error
             try:
                 req = prepare_request(request)
                 auth = init_saml_auth(req, saml_config)
@@ -402,7 +423,7 @@ def handle_user_registration_infos(inpt, email, activation_required):
     :param inpt: the form containing the password confirm-password and email fields
     :param activation_required: set to true if the user still has to activate its account as of now
     :return: a new user
-    :raises: UnicodeEncodeError
+    :raises: UnicodeEncodeError, PasswordHashingRefused
     """
     password = inpt["password"]
     confirm_password = inpt["confirm-password"]
@@ -418,9 +439,7 @@ def handle_user_registration_infos(inpt, email, activation_required):
     if error:
         return None
 
-    password_hash = hash_password_func(email=email, password=password,
-                                       global_salt=syllabus.get_config().get('password_salt', None),
-                                       n_iterations=syllabus.get_config().get('password_hash_iterations', 100000))
+    password_hash = hash_password(email, password, client_ip=request.remote_addr)
     return User(email, hash_password=password_hash, right=None, activated=not activation_required)
 
 
@@ -440,7 +459,6 @@ def register():
         if activation_required:
             # send the email confirmation
             email = inpt["email"]
-            auth_config = email_activation_config.get("authentication", {})
             parsed_url = urllib.parse.urlparse(urllib.parse.urljoin(request.host_url, "activate"))
             parsed_url = parsed_url._replace(query=urllib.parse.urlencode({
                 "email": email,
@@ -448,19 +466,8 @@ def register():
                 "ts": timestamp
             }))
             url = urllib.parse.urlunparse(parsed_url)
-            if auth_config.get("required", False):
-                send_authenticated_confirmation_mail(email_activation_config["sender_email_address"], email,
-                                                     url,
-                                                     email_activation_config["smtp_server"],
-                                                     username=auth_config["username"],
-                                                     password=auth_config["password"],
-                                                     smtp_port=email_activation_config["smtp_server_port"])
-            else:
-                send_confirmation_mail(email_activation_config["sender_email_address"], email,
-                                       url,
-                                       email_activation_config["smtp_server"],
-                                       use_ssl=email_activation_config["use_ssl"],
-                                       smtp_port=email_activation_config["smtp_server_port"])
+            # the e-mail is sent in the background, a slow SMTP server does not delay the registration
+            queue_confirmation_mail(email_activation_config["sender_email_address"], email, url)
             feedback_message = "Registration successful. Please activate your account using the activation link you received by e-mail." \
                                "Click <a href=\"/login\">here</a> to log in."
             set_feedback(session, SuccessFeedback(feedback_message), feedback_type="login")
@@ -473,6 +480,9 @@ def register():
         except UnicodeEncodeError:
             # TODO: log
             return seeother("/login")
+        except PasswordHashingRefused as e:
+            set_feedback(session, ErrorFeedback(str(e)), feedback_type="login")
+            return seeother("/register")
 
         if u is None:
             return seeother("/register")
@@ -524,6 +534,9 @@ def activate_account():
         except UnicodeEncodeError:
             # TODO: log
             return seeother("/login")
+        except PasswordHashingRefused as e:
+            set_feedback(session, ErrorFeedback(str(e)), feedback_type="login")
+            return seeother("/activate?{}".format(urllib.parse.urlencode({"email": email, "token": mac, "ts": ts})))
 
         if u is None:
             return seeother("/activate?{}".format(urllib.parse.urlencode({"email": email, "token": mac, "ts": ts})))
@@ -543,18 +556,51 @@ def activate_account():
 
 @app.route('/postinginious/<string:course>', methods=['POST'])
 def post_inginious(course):
-    inpt = request.form
-    data = parse.urlencode(inpt).encode()
-    inginious_config = syllabus.get_config()['courses'][course]['inginious']
-    path = safe_join(inginious_config.get("simple_grader_pattern", "/"), inginious_config['course_id'])
-    inginious_sandbox_url = urllib.parse.urljoin(inginious_config["url"], path)
-    req = urllib_request.Request(inginious_sandbox_url, data=data)
-    resp = urllib_request.urlopen(req)
-    response = make_response(resp.read().decode())
+    if course not in syllabus.get_config()["courses"].keys():
+        abort(404)
+    # never let the submissions waiting for INGInious take all the threads serving the pages
+    if not post_inginious.semaphore.acquire(blocking=False):
+        response = make_response("Too many submissions are being graded, please try again.", 503)
+        response.headers['Retry-After'] = '5'
+        return response
+    try:
+        client_config = syllabus.get_config().get("inginious_client", None) or {}
+        try:
+            # a submission must not be sent twice
+            resp = get_inginious_client().request("POST", get_inginious_sandbox_url(course), data=request.form,
+                                                  name="submission_proxy",
+                                                  timeout=client_config.get("submission_timeout", 60), retries=0)
+        except INGIniousError:
+            abort(502)
+    finally:
+        post_inginious.semaphore.release()
+    response = make_response(resp.text())
     response.headers['Content-Type'] = 'text/json'
     return response
 
 
+post_inginious.semaphore = threading.BoundedSemaphore(
+    (syllabus.get_config().get("submission_proxy", None) or {}).get("max_concurrent_requests", 4))
+
+
+@app.route('/lti_launch/<string:course>/<string:task_id>', methods=['GET'])
+def lti_launch(course, task_id):
+    """
+    Signs the LTI launch of the task for the logged in user and returns a page that submits it to INGInious.
+    This page is loaded in the iframe of the exercise, so that the pages themselves do not contain any user-specific data.
+    """
+    if course not in syllabus.get_config()["courses"].keys() \
+            or "lti" not in syllabus.get_config()["courses"][course]["inginious"]:
+        abort(404)
+    if "user" not in session:
+        abort(403)
+    data, launch_url = get_lti_data(course, session["user"]["email"], task_id)
+    response = make_response(render_template("lti_launch.html", data=data, launch_url=launch_url))
+    # the launch data are signed with a nonce and a timestamp, they cannot be reused
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @app.route('/parserst', methods=['POST'])
 def parse_rst():
     inpt = request.form["rst"]
@@ -579,14 +625,10 @@ def saml():
         errors = auth.get_errors()
         # Try and check if IdP is using several signature certificates
         # This is a limitation of python3-saml
-        for cert in saml_config["idp"].get("additionalX509certs", []):
+        for settings in get_alternative_saml_settings(saml_config):
             if auth.get_last_error_reason() == "Signature validation failed. SAML Response rejected":
-                import copy
-                # Change used IdP certificate
-                new_settings = copy.deepcopy(saml_config)
-                new_settings["idp"]["x509cert"] = cert
-                # Retry processing response
-                auth = init_saml_auth(req, new_settings)
+                # Retry processing response with the next IdP certificate
+                auth = init_saml_auth(req, saml_config, settings=settings)
                 auth.process_response()
                 errors = auth.get_errors()
         if len(errors) == 0:
@@ -610,6 +652,7 @@ def saml():
             session["user"] = user.to_dict()
             session["user"].update({"login_method": "saml"})
 
+            from onelogin.saml2.utils import OneLogin_Saml2_Utils
             self_url = OneLogin_Saml2_Utils.get_self_url(req)
             if 'RelayState' in request.form and self_url != request.form['RelayState']:
                 return redirect(auth.redirect_to(request.form['RelayState']))
@@ -619,11 +662,8 @@ def saml():
 
 @app.route('/saml/metadata/')
 def metadata():
-    req = prepare_request(request)
-    auth = init_saml_auth(req, saml_config)
-    settings = auth.get_settings()
-    metadata = settings.get_sp_metadata()
-    errors = settings.validate_metadata(metadata)
+    # the metadata only depend on the configuration, they are generated and validated once
+    metadata, errors = get_sp_metadata(saml_config)
 
     if len(errors) == 0:
         resp = make_response(metadata, 200)
@@ -638,11 +678,29 @@ def update_pages(secret, course):
     params = Params.query.one()
     if secret != params.git_hook_url or 'git' not in syllabus.get_config()['courses'][course]['pages']:
         return seeother("/")
-    syllabus.utils.pages.init_and_sync_repo(course, force_sync=True)
-    return "done"
+    # the pages are synchronized in the background, the pushes received meanwhile are coalesced
+    get_sync_scheduler(course, app).request()
+    return "scheduled"
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe for the load balancer, the worker is warmed up by the first call if it was not done at startup.
+    Answers 503 until every course is ready.
+    """
+    state = ensure_warm(app)
+    if state is None:
+        return jsonify({"ready": False, "warming_up": True}), 503
+    return jsonify(state), 200 if state["ready"] else 503
 
 
 def main():
     update_database()
     init_db()
     app.run(host='0.0.0.0', port=5000)
+
+
+# with gunicorn --preload, the workers are forked after this import and share the warmed up structures
+if get_warmup_config()["on_import"]:
+    ensure_warm(app, before_fork=True)
@@ -1,7 +1,7 @@
 import hmac
 from hmac import HMAC
 
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Index, func
 from syllabus.database import Base
 from hashlib import sha512, pbkdf2_hmac, sha256
 
@@ -14,6 +14,9 @@ class User(Base):
     change_password_url = Column(String(50))
     right = Column(String(30))
     activated = Column(Boolean(), nullable=False, default=False)
+    # used by the case-insensitive prefix search of the admin panel
+    __table_args__ = (Index("ix_users_email_lower", func.lower(email)),
+                      Index("ix_users_full_name_lower", func.lower(full_name)))
 
     def __init__(self, email, hash_password, full_name=None, change_password_url=None, right=None,
                  activated=False):
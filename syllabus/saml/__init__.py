@@ -1,15 +1,55 @@
+import copy
 from urllib.parse import urlparse
 
 import os
 
 import syllabus
-from onelogin.saml2.auth import OneLogin_Saml2_Auth
-from onelogin.saml2.utils import OneLogin_Saml2_Utils
 
+# onelogin is imported by the functions below, only when the SAML authentication is used
 
-def init_saml_auth(req, saml_config):
-    auth = OneLogin_Saml2_Auth(req, saml_config, custom_base_path=os.path.join(syllabus.get_root_path(), "saml"))
-    return auth
+
+def _get_cached_saml_data(saml_config):
+    """
+    Parses and validates saml_config once for each version of the configuration.
+    :return: a dict containing the settings, the list of the alternative settings using each certificate of
+    idp.additionalX509certs, the SP metadata and its validation errors
+    """
+    cached = getattr(_get_cached_saml_data, "cached", None)
+    # a new configuration object is loaded each time the configuration is modified
+    if cached is None or cached[0] is not saml_config:
+        from onelogin.saml2.settings import OneLogin_Saml2_Settings
+        base_path = os.path.join(syllabus.get_root_path(), "saml")
+        settings = OneLogin_Saml2_Settings(saml_config, base_path)
+        alternative_settings = []
+        for cert in saml_config["idp"].get("additionalX509certs", []):
+            # Change used IdP certificate
+            new_config = copy.deepcopy(saml_config)
+            new_config["idp"]["x509cert"] = cert
+            alternative_settings.append(OneLogin_Saml2_Settings(new_config, base_path))
+        metadata = settings.get_sp_metadata()
+        data = {"settings": settings, "alternative_settings": alternative_settings,
+                "metadata": metadata, "metadata_errors": settings.validate_metadata(metadata)}
+        _get_cached_saml_data.cached = (saml_config, data)
+    return _get_cached_saml_data.cached[1]
+
+
+def get_alternative_saml_settings(saml_config):
+    """ :return: the settings to try when the IdP signed the response with one of the additional certificates """
+    return _get_cached_saml_data(saml_config)["alternative_settings"]
+
+
+def get_sp_metadata(saml_config):
+    """ :return: a (metadata, errors) tuple containing the SP metadata XML and the errors of its validation """
+    data = _get_cached_saml_data(saml_config)
+    return data["metadata"], data["metadata_errors"]
+
+
+def init_saml_auth(req, saml_config, settings=None):
+    """
+    :param settings: the settings to use instead of the ones parsed from saml_config, e.g. the alternative settings
+    """
+    from onelogin.saml2.auth import OneLogin_Saml2_Auth
+    return OneLogin_Saml2_Auth(req, settings if settings is not None else _get_cached_saml_data(saml_config)["settings"])
 
 
 def prepare_request(request):
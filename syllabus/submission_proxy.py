@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the Interactive Syllabus project
+#
+#    Copyright (C) 2017  Alexandre Dubray, François Michel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Standalone asynchronous same origin proxy for the INGInious submissions.
+
+The grading of a submission can take many seconds. Instead of parking a worker of the syllabus on each of them, the
+front-end server can route the /postinginious/ requests to this proxy, which relays them to INGInious on a single
+asyncio event loop. Run it with:
+
+    python3 -m syllabus.submission_proxy
+
+and route /postinginious/ to submission_proxy.host:submission_proxy.port in the front-end server.
+"""
+
+import asyncio
+import re
+import ssl
+import sys
+from urllib.parse import urlsplit
+
+import syllabus
+from syllabus.utils.inginious_client import get_inginious_sandbox_url
+
+path_regex = re.compile(r'^/postinginious/([^/?]+)/?(\?.*)?$')
+max_body_size = 1024 * 1024
+chunk_size = 16384
+
+
+def get_proxy_config():
+    proxy_config = syllabus.get_config().get("submission_proxy", None) or {}
+    client_config = syllabus.get_config().get("inginious_client", None) or {}
+    return {
+        "host": proxy_config.get("host", "127.0.0.1"),
+        "port": proxy_config.get("port", 5001),
+        "max_concurrent_upstream": proxy_config.get("max_concurrent_upstream", 100),
+        "queue_timeout": proxy_config.get("queue_timeout", 10),
+        "connect_timeout": client_config.get("timeout", 10),
+        "submission_timeout": client_config.get("submission_timeout", 60),
+    }
+
+
+class SubmissionProxy(object):
+    def __init__(self, config):
+        self.config = config
+        self.semaphore = asyncio.Semaphore(config["max_concurrent_upstream"])
+
+    @staticmethod
+    async def _send_error(writer, status, reason):
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % (status, reason)).encode())
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            await self._handle(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.config["connect_timeout"])
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError):
+            return await self._send_error(writer, 400, "Bad Request")
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, _ = request_line.split(" ", 2)
+        except ValueError:
+            return await self._send_error(writer, 400, "Bad Request")
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+        match = path_regex.match(path)
+        courses = syllabus.get_config()["courses"]
+        # only the courses using the same origin proxy are relayed
+        if match is None or match.group(1) not in courses \
+                or not courses[match.group(1)].get("inginious", {}).get("same_origin_proxy", False):
+            return await self._send_error(writer, 404, "Not Found")
+        if method != "POST":
+            return await self._send_error(writer, 405, "Method Not Allowed")
+        try:
+            content_length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            return await self._send_error(writer, 400, "Bad Request")
+        if content_length < 0:
+            return await self._send_error(writer, 400, "Bad Request")
+        if content_length > max_body_size:
+            return await self._send_error(writer, 413, "Payload Too Large")
+        try:
+            body = await asyncio.wait_for(reader.readexactly(content_length), self.config["connect_timeout"])
+        except asyncio.TimeoutError:
+            return await self._send_error(writer, 408, "Request Timeout")
+
+        # bound the number of submissions waiting for INGInious, the others wait in the queue for a limited time
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.config["queue_timeout"])
+        except asyncio.TimeoutError:
+            return await self._send_error(writer, 503, "Service Unavailable")
+        try:
+            await self._relay(match.group(1), headers.get("content-type", "application/x-www-form-urlencoded"), body,
+                              writer, query=(match.group(2) or "")[1:])
+        finally:
+            self.semaphore.release()
+
+    async def _relay(self, course, content_type, body, writer, query=""):
+        upstream_url = urlsplit(get_inginious_sandbox_url(course))
+        # the query string of the client is forwarded unchanged
+        target = upstream_url.path or "/"
+        query = "&".join(part for part in [upstream_url.query, query] if part)
+        if query:
+            target += "?" + query
+        https = upstream_url.scheme == "https"
+        port = upstream_url.port or (443 if https else 80)
+        try:
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                asyncio.open_connection(upstream_url.hostname, port, ssl=ssl.create_default_context() if https else None),
+                self.config["connect_timeout"])
+        except (OSError, asyncio.TimeoutError):
+            return await self._send_error(writer, 502, "Bad Gateway")
+        try:
+            # HTTP/1.0: INGInious closes the connection at the end of the response body, which is relayed as it comes
+            upstream_writer.write(("POST %s HTTP/1.0\r\nHost: %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n"
+                                   % (target, upstream_url.netloc, content_type, len(body))).encode()
+                                  + body)
+            await upstream_writer.drain()
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + self.config["submission_timeout"]
+            try:
+                head = await asyncio.wait_for(upstream_reader.readuntil(b"\r\n\r\n"), deadline - loop.time())
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return await self._send_error(writer, 504, "Gateway Timeout")
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")
+            status = status_line.split(" ", 1)[1] if " " in status_line else "502 Bad Gateway"
+            response_head = "HTTP/1.1 %s\r\nContent-Type: text/json\r\nConnection: close\r\n" % status
+            for line in header_lines:
+                if line.lower().startswith("content-length:"):
+                    response_head += line + "\r\n"
+            writer.write((response_head + "\r\n").encode("latin-1"))
+            while True:
+                chunk = await asyncio.wait_for(upstream_reader.read(chunk_size), max(deadline - loop.time(), 0))
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        except asyncio.TimeoutError:
+            # the headers have already been sent, the truncated response is detected by the client
+            pass
+        finally:
+            upstream_writer.close()
+
+
+async def serve(config):
+    proxy = SubmissionProxy(config)
+    server = await asyncio.start_server(proxy.handle, config["host"], config["port"])
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    config = get_proxy_config()
+    print("INGInious submission proxy listening on %s:%d" % (config["host"], config["port"]), file=sys.stderr)
+    asyncio.run(serve(config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import gzip
+import mimetypes
+import os
+import re
+import sys
+from hashlib import sha256
+from urllib.parse import quote, urlencode
+
+from flask import send_from_directory, abort, Response, request, current_app
+from werkzeug.security import safe_join
+
+import syllabus
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, only the gzip siblings are produced without it
+    brotli = None
+
+# fingerprinted assets never change: the browser can keep them for a year without revalidating them
+fingerprinted_cache_control = "public, max-age=31536000, immutable"
+
+course_asset_url_regex = re.compile(r'^/syllabus/(?P<course>[^/]+)/(?:(?P<content_path>.+?)/)?assets/(?P<asset_path>.+)$')
+asset_attribute_regex = re.compile(r'(src|href)="(/(?:static|syllabus)/[^"?#]+)"')
+
+# sibling extension of the precompressed files, by order of preference
+precompressed_encodings = [("br", ".br"), ("gzip", ".gz")]
+precompressed_file_extensions = [".css", ".js", ".map", ".svg", ".json", ".txt", ".xml", ".ttf", ".otf", ".eot"]
+precompress_min_size = 1024
+
+# parts of the HTML whose whitespace is meaningful and must not be touched by the minification
+whitespace_sensitive_regex = re.compile(r'(<(pre|textarea|script)\b.*?</\2>)', re.DOTALL | re.IGNORECASE)
+whitespace_regex = re.compile(r'\s+')
+
+
+def get_offload_mode():
+    """
+    :return: the configured file offload mode ("x-sendfile", "x-accel-redirect") or None if the files must
+    be streamed by the syllabus itself
+    """
+    offload_config = syllabus.get_config().get("file_offload", None) or {}
+    mode = offload_config.get("mode", None)
+    return mode if mode in ["x-sendfile", "x-accel-redirect"] else None
+
+
+def send_asset(directory, filename):
+    """
+    Serves the file located at filename inside directory. The access checks must be done before calling this function.
+    If a file offload mode is configured, the response only contains the header telling the front-end server which file
+    to send, so that the byte transfer does not keep the worker busy.
+    If the request carries the current fingerprint of the file, the response can be cached forever by the browser.
+    """
+    mode = get_offload_mode()
+    path = safe_join(directory, filename)
+    encoding, extension = get_precompressed_encoding(path)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if mode is None:
+        response = send_from_directory(directory, filename + extension, mimetype=mimetype)
+    else:
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        path = os.path.abspath(path)
+        response = Response(mimetype=mimetype)
+        if mode == "x-sendfile":
+            response.headers["X-Sendfile"] = path + extension
+        else:
+            location = syllabus.get_config()["file_offload"].get("internal_location", None) or "/_sendfile"
+            response.headers["X-Accel-Redirect"] = quote(location.rstrip("/") + path + extension)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    if path is not None and any(os.path.isfile(path + ext) for _, ext in precompressed_encodings):
+        response.vary.add("Accept-Encoding")
+    fingerprint = request.args.get("v", None)
+    if fingerprint is not None and fingerprint == get_asset_fingerprint(path):
+        response.headers["Cache-Control"] = fingerprinted_cache_control
+        response.headers.pop("Expires", None)
+    return response
+
+
+def get_precompressed_encoding(path):
+    """
+    :return: a (content encoding, sibling extension) tuple designating the best up-to-date precompressed sibling of the
+    file at path accepted by the client, or (None, "") if the file must be sent as is
+    """
+    if path is None or not os.path.isfile(path):
+        return None, ""
+    for encoding, extension in precompressed_encodings:
+        if request.accept_encodings[encoding] > 0 and os.path.isfile(path + extension) \
+                and os.path.getmtime(path + extension) >= os.path.getmtime(path):
+            return encoding, extension
+    return None, ""
+
+
+def precompress_file(path):
+    """ Writes the gzip (and brotli if available) siblings of the file at path if they are missing or outdated. """
+    with open(path, "rb") as f:
+        data = None
+        for encoding, extension in precompressed_encodings:
+            if encoding == "br" and brotli is None:
+                continue
+            if os.path.isfile(path + extension) and os.path.getmtime(path + extension) >= os.path.getmtime(path):
+                continue
+            data = f.read() if data is None else data
+            compressed = brotli.compress(data) if encoding == "br" else gzip.compress(data, compresslevel=9)
+            if len(compressed) >= len(data):
+                # not worth it, the original file will be served
+                continue
+            with open(path + extension + ".tmp", "wb") as out:
+                out.write(compressed)
+            os.replace(path + extension + ".tmp", path + extension)
+
+
+def is_precompressible(path):
+    """ :return: True if the file at path is worth being precompressed """
+    return os.path.splitext(path)[1] in precompressed_file_extensions and os.path.getsize(path) >= precompress_min_size
+
+
+def precompress_directory(directory):
+    """ Precompresses every compressible file of the given directory and its subdirectories. """
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not is_precompressible(path):
+                continue
+            try:
+                precompress_file(path)
+            except OSError as e:
+                print("could not precompress %s: %s" % (path, e), file=sys.stderr)
+
+
+def precompress_static_files():
+    """ The static build step: precompresses the /static/ files and the assets of every non-Sphinx course. """
+    precompress_directory(os.path.join(syllabus.get_root_path(), "static"))
+    for course in syllabus.get_courses():
+        if syllabus.get_config()["courses"][course].get("sphinx"):
+            continue
+        pages_path = syllabus.get_pages_path(course)
+        for root, dirs, files in os.walk(pages_path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if os.path.basename(root) == "assets":
+                precompress_directory(root)
+                dirs[:] = []
+
+
+def minify_html(html):
+    """ Collapses the whitespace of the given HTML, except inside the pre, textarea and script elements. """
+    parts = whitespace_sensitive_regex.split(html)
+    result = []
+    # split() returns the text between the matches, the whole match and the tag name alternately
+    for i in range(0, len(parts), 3):
+        result.append(whitespace_regex.sub(" ", parts[i]))
+        if i + 1 < len(parts):
+            result.append(parts[i + 1])
+    return "".join(result).strip()
+
+
+def get_asset_fingerprint(path):
+    """
+    :return: a short hash of the content of the file located at path, or None if there is no such file.
+    The hashes are kept in the asset manifest and only recomputed when the file is modified.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = get_asset_fingerprint.manifest.get(path, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    h = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    fingerprint = h.hexdigest()[:16]
+    get_asset_fingerprint.manifest[path] = (version, fingerprint)
+    return fingerprint
+
+
+get_asset_fingerprint.manifest = {}
+
+
+def get_asset_path(url):
+    """
+    :return: the path of the file served at the given /static/ or course assets url, None if the url does not
+    point to an asset
+    """
+    if url.startswith("/static/"):
+        return safe_join(current_app.static_folder, url[len("/static/"):])
+    match = course_asset_url_regex.match(url)
+    if match is None:
+        return None
+    course = match.group("course")
+    course_config = syllabus.get_config()["courses"].get(course, None)
+    if course_config is None or course_config.get("sphinx"):
+        return None
+    content_path = match.group("content_path")
+    if content_path is None:
+        directory = os.path.join(syllabus.get_pages_path(course), "assets")
+    else:
+        directory = safe_join(syllabus.get_pages_path(course), content_path, "assets")
+    return safe_join(directory, match.group("asset_path")) if directory is not None else None
+
+
+def fingerprinted_url(url):
+    """ Returns the url with the fingerprint of the asset appended, or the unchanged url if it is not an asset. """
+    fingerprint = get_asset_fingerprint(get_asset_path(url))
+    if fingerprint is None:
+        return url
+    return "%s?%s" % (url, urlencode({"v": fingerprint}))
+
+
+def fingerprint_urls(html):
+    """ Adds the fingerprint to every asset referenced by a src or href attribute of the given html. """
+    return asset_attribute_regex.sub(lambda m: '%s="%s"' % (m.group(1), fingerprinted_url(m.group(2))), html)
+
+
+if __name__ == "__main__":
+    precompress_static_files()
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import syllabus
+
+
+class SQLiteCache(object):
+    """
+    A key-value cache whose entries expire after a given time to live. It is stored in a SQLite database so that it
+    is shared by all the worker processes of the syllabus. Keys are tuples of strings, values must be JSON-serializable
+    (None is a valid value, it can be used for negative caching).
+    """
+    # the cache is pruned every prune_interval insertions
+    prune_interval = 100
+
+    def __init__(self, path, table, max_entries=10000):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._n_insertions = 0
+        self._get_connection().execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT, "
+                                       "expires REAL NOT NULL)".format(self.table))
+
+    def _get_connection(self):
+        # sqlite3 connections cannot be shared between threads, nor with the processes forked after their opening
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _dump_key(key):
+        return json.dumps(list(key))
+
+    def get(self, key):
+        """
+        :return: a (found, value) tuple. found is False if there is no valid entry for this key in the cache.
+        """
+        try:
+            row = self._get_connection().execute("SELECT value FROM {} WHERE key = ? AND expires > ?".format(self.table),
+                                                 (self._dump_key(key), time.time())).fetchone()
+        except sqlite3.Error:
+            # a broken cache must never break the rendering of a page
+            return False, None
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        try:
+            self._get_connection().execute("INSERT OR REPLACE INTO {} (key, value, expires) VALUES (?, ?, ?)".format(self.table),
+                                           (self._dump_key(key), json.dumps(value), time.time() + ttl))
+            self._n_insertions += 1
+            if self._n_insertions % self.prune_interval == 0:
+                self.prune()
+        except sqlite3.Error:
+            pass
+
+    def increment(self, key, ttl):
+        """
+        Atomically increments the integer counter stored under key, even if other workers increment it at the same
+        time. An expired or missing counter restarts at 1 and expires in ttl seconds, the expiry of a valid counter is
+        kept.
+        :return: the new value of the counter, None if the cache is broken
+        """
+        now = time.time()
+        try:
+            row = self._get_connection().execute(
+                "INSERT INTO {} (key, value, expires) VALUES (?, '1', ?) ON CONFLICT (key) DO UPDATE SET "
+                "value = CASE WHEN expires > ? THEN CAST(value AS INTEGER) + 1 ELSE 1 END, "
+                "expires = CASE WHEN expires > ? THEN expires ELSE excluded.expires END "
+                "RETURNING value".format(self.table), (self._dump_key(key), now + ttl, now, now)).fetchone()
+            self._n_insertions += 1
+            if self._n_insertions % self.prune_interval == 0:
+                self.prune()
+        except sqlite3.Error:
+            return None
+        return int(row[0])
+
+    def delete(self, key):
+        try:
+            self._get_connection().execute("DELETE FROM {} WHERE key = ?".format(self.table), (self._dump_key(key),))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        self._get_connection().execute("DELETE FROM {}".format(self.table))
+
+    def prune(self):
+        """ Removes the expired entries, then the entries expiring first if the cache is still too large. """
+        connection = self._get_connection()
+        connection.execute("DELETE FROM {} WHERE expires <= ?".format(self.table), (time.time(),))
+        n_entries = connection.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+        if n_entries > self.max_entries:
+            connection.execute("DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY expires LIMIT ?)".format(self.table),
+                               (n_entries - self.max_entries,))
+
+
+def get_cache_path():
+    """
+    :return: the path of the SQLite file holding the caches shared by the workers. It can be set with the
+    "shared_cache_path" configuration entry, and defaults to cache.sqlite next to the default database.
+    """
+    path = syllabus.get_config().get("shared_cache_path", None)
+    return path if path is not None else os.path.join(syllabus.get_root_path(), "cache.sqlite")
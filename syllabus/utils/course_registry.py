@@ -0,0 +1,194 @@
+"""
+Registry of the courses resident in the memory of this worker. The objects loaded for a course, its TOC or its Sphinx
+application, are kept with their approximate memory footprint and the courses are ordered by their last use. The least
+recently used courses are evicted when the budget of the worker is exceeded, or when they have not been visited for
+course_registry.idle_timeout seconds, and are loaded again from the disk on their next visit.
+
+The registry entries are keyed by (kind, directory) tuples. When a course is evicted, the task ids of its compiled
+pages and the fingerprints of the assets located in these directories are forgotten as well.
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import BuiltinFunctionType, FrameType, FunctionType, ModuleType
+
+import syllabus
+
+# shared by all the courses, they are not counted in their footprint
+_shared_types = (type, ModuleType, FunctionType, BuiltinFunctionType, FrameType)
+
+
+def get_course_registry_config():
+    registry_config = syllabus.get_config().get("course_registry", None) or {}
+    return {
+        "max_memory": registry_config.get("max_memory", 256),
+        "max_courses": registry_config.get("max_courses", None),
+        "idle_timeout": registry_config.get("idle_timeout", 86400),
+    }
+
+
+def get_footprint(obj):
+    """
+    :return: the approximate size in bytes of the objects reachable from obj. The classes, modules, functions and
+    module globals are shared by all the courses and are not counted.
+    """
+    seen = {id(module.__dict__) for module in list(sys.modules.values()) if module is not None}
+    pending = [obj]
+    size = 0
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, _shared_types):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current, 0)
+        pending.extend(gc.get_referents(current))
+    return size
+
+
+def _forget_course(course, directories):
+    # imported here as these modules import the heavy part of the pages rendering
+    from syllabus.utils.assets import get_asset_fingerprint
+    from syllabus.utils.pages import get_task_ids
+    for key in [key for key in list(get_task_ids.index) if key[0] == course]:
+        get_task_ids.index.pop(key, None)
+    prefixes = tuple(os.path.join(directory, "") for directory in directories)
+    if prefixes:
+        for path in [path for path in list(get_asset_fingerprint.manifest) if path.startswith(prefixes)]:
+            get_asset_fingerprint.manifest.pop(path, None)
+
+
+class CourseRegistry(object):
+    """
+    Keeps the objects loaded for each course in the order of the last use of the courses. max_memory is in bytes,
+    None disables a limit.
+    """
+    def __init__(self, max_memory=None, max_courses=None, idle_timeout=None):
+        self.max_memory = max_memory
+        self.max_courses = max_courses
+        self.idle_timeout = idle_timeout
+        # course -> {"entries": {key: (version, value, footprint)}, "last_used": monotonic time}
+        self._courses = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "loads": 0, "evictions": 0, "idle_evictions": 0}
+
+    def _touch(self, course, now):
+        course_entry = self._courses.get(course, None)
+        if course_entry is None:
+            course_entry = self._courses[course] = {"entries": {}, "last_used": now}
+        course_entry["last_used"] = now
+        self._courses.move_to_end(course)
+        return course_entry
+
+    def get(self, course, key, version, loader, force=False):
+        """
+        :return: the object of the course stored under key, loaded by calling loader if it is not resident, if its
+        version differs from the given one or if force is True
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._touch(course, now)["entries"].get(key, None)
+            hit = entry is not None and entry[0] == version and not force
+            if hit:
+                self._stats["hits"] += 1
+                evicted = self._evict_idle(now)
+        if hit:
+            self._forget(evicted)
+            return entry[1]
+        # the loading can be long, e.g. a Sphinx build, the other courses are served meanwhile
+        value = loader()
+        footprint = get_footprint(value)
+        with self._lock:
+            self._touch(course, now)["entries"][key] = (version, value, footprint)
+            self._stats["loads"] += 1
+            evicted = self._evict_idle(now) + self._enforce_budget(course)
+        self._forget(evicted)
+        return value
+
+    def get_keys(self, course):
+        """ :return: the keys of the resident objects of the course """
+        with self._lock:
+            course_entry = self._courses.get(course, None)
+            return list(course_entry["entries"]) if course_entry is not None else []
+
+    def discard(self, course, key):
+        """ Forgets the object of the course stored under key. """
+        with self._lock:
+            course_entry = self._courses.get(course, None)
+            if course_entry is not None:
+                course_entry["entries"].pop(key, None)
+
+    def evict(self, course):
+        """ Forgets everything that was loaded for the course. """
+        with self._lock:
+            evicted = self._pop(course)
+        self._forget(evicted)
+
+    def _pop(self, course):
+        course_entry = self._courses.pop(course, None)
+        if course_entry is None:
+            return []
+        self._stats["evictions"] += 1
+        return [(course, [key[1] for key in course_entry["entries"]])]
+
+    def _evict_idle(self, now):
+        evicted = []
+        if self.idle_timeout is not None:
+            while self._courses:
+                course, course_entry = next(iter(self._courses.items()))
+                if now - course_entry["last_used"] <= self.idle_timeout:
+                    break
+                self._stats["idle_evictions"] += 1
+                evicted += self._pop(course)
+        return evicted
+
+    def _get_total_footprint(self):
+        return sum(entry[2] for course_entry in self._courses.values() for entry in course_entry["entries"].values())
+
+    def _enforce_budget(self, current_course):
+        """ Evicts the least recently used courses until the budget is met, the current course is always kept. """
+        evicted = []
+        while len(self._courses) > 1:
+            over_courses = self.max_courses is not None and len(self._courses) > self.max_courses
+            over_memory = self.max_memory is not None and self._get_total_footprint() > self.max_memory
+            if not over_courses and not over_memory:
+                break
+            course = next(iter(self._courses))
+            if course == current_course:
+                break
+            evicted += self._pop(course)
+        return evicted
+
+    @staticmethod
+    def _forget(evicted):
+        for course, directories in evicted:
+            _forget_course(course, directories)
+
+    def get_stats(self):
+        """ :return: the counters of this registry and the footprint of each resident course, in bytes """
+        now = time.monotonic()
+        with self._lock:
+            courses = {}
+            for course, course_entry in self._courses.items():
+                entries = [{"kind": key[0], "path": key[1], "footprint": entry[2]}
+                           for key, entry in course_entry["entries"].items()]
+                courses[course] = {"footprint": sum(entry["footprint"] for entry in entries),
+                                   "idle": now - course_entry["last_used"], "entries": entries}
+            stats = dict(self._stats)
+            stats.update(max_memory=self.max_memory, max_courses=self.max_courses, idle_timeout=self.idle_timeout,
+                         footprint=self._get_total_footprint(), courses=courses)
+            return stats
+
+
+def get_course_registry():
+    """ :return: the course registry of this process, as configured by the course_registry configuration section """
+    if not hasattr(get_course_registry, "cached"):
+        registry_config = get_course_registry_config()
+        max_memory = registry_config["max_memory"]
+        get_course_registry.cached = CourseRegistry(
+            max_memory=max_memory * 1024 * 1024 if max_memory is not None else None,
+            max_courses=registry_config["max_courses"], idle_timeout=registry_config["idle_timeout"])
+    return get_course_registry.cached
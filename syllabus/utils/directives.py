@@ -26,6 +26,22 @@ from docutils.statemachine import StringList
 import docutils.parsers.rst.directives
 
 
+def get_current_course():
+    """
+    :return: the course whose content is being compiled, as set in flask.g by the request handler. The rst rendered
+    outside of a course (the cheat sheet, /parserst) uses the course kept in the sessions of the previous versions or
+    the default course, None if there is none.
+    """
+    from flask import g, session, has_request_context
+    import syllabus
+    course = g.get("course", None)
+    if course is None and has_request_context():
+        course = session.get("course", None)
+    if course is None:
+        course = syllabus.get_config().get("default_course", None)
+    return course
+
+
 def uri(argument):
     """
     Return the URI argument with whitespace removed.
@@ -35,9 +51,11 @@ def uri(argument):
     if argument is None:
         raise ValueError('argument required but none supplied')
     else:
-        from flask import session
         uri = ''.join(argument.split())
-        return re.sub('^/assets/', '/syllabus/{}/assets/'.format(session["course"]), uri)
+        course = get_current_course()
+        if course is None:
+            return uri
+        return re.sub('^/assets/', '/syllabus/{}/assets/'.format(course), uri)
 
 
 # Oh yeah baby!
@@ -61,7 +79,7 @@ class InginiousDirective(Directive):
     optional argument 2: the number of blank lines to display in print mode
     directive content: the prefilled code in the text area
 
-    The directive will display the content in print mode if the "print" attribute is set to True in the session.
+    The directive will display the content in print mode if the page is rendered with print_mode set to True.
     """
     has_content = True
     required_arguments = 1
@@ -83,7 +101,6 @@ class InginiousDirective(Directive):
 
     def get_html_content(self, sandbox):
 
-        from flask import session
         html_no_lti = """
         {{% set action_to_do = '/postinginious/{3}' %}}
         {{% if not inginious_config['same_origin_proxy'] %}}
@@ -103,28 +120,14 @@ class InginiousDirective(Directive):
         """.format(self.arguments[2] if len(self.arguments) == 3 else "text/x-python",
                    '\n'.join(self.content),
                    self.arguments[0],
-                   session["course"])
+                   get_current_course())
 
         html_lti = """
         {{% set user = session.get("user", None) %}}
         {{% if user is not none %}}
-            {{% set data, launch_url = get_lti_data(course_str, logged_in["email"] if logged_in is not none else none, "{0}") %}}
-            {{% set inputs_list = [] %}}
-            {{% for key, value in data.items() %}}
-                {{% set a = inputs_list.append('<input type="hidden" name="{{0}}" value="{{1}}" />'.format(key, value)) %}}
-            {{% endfor %}}
-            {{% set form_inputs = '\\n'.join(inputs_list) %}}
+            {{# the LTI launch data are signed by /lti_launch only when the iframe is loaded #}}
             <iframe name="myIframe{0}" frameborder="0" allowfullscreen"true" webkitallowfullscreen="true" mozallowfullscreen="true" scrolling="no"
-                style="overflow: hidden; width: 100%; height: 520px" src=""></iframe>
-            <form action="{{{{ launch_url }}}}"
-                  name="ltiLaunchForm"
-                  class="ltiLaunchForm"
-                  method="POST"
-                  encType="application/x-www-form-urlencoded"
-                  target="myIframe{0}">
-            {{{{ form_inputs|safe }}}}
-            <button class="inginious-submitter" type="submit">Launch the INGInious exercise</button>
-            </form>
+                style="overflow: hidden; width: 100%; height: 520px" loading="lazy" src="/lti_launch/{{{{ course_str }}}}/{0}"></iframe>
         {{% elif login_img is defined and login_img is not none %}}
             <a href="/login"><img style="width: 100%" src="{{{{ login_img }}}}"></a>
         {{% else %}}
@@ -152,6 +155,10 @@ class InginiousDirective(Directive):
         c.append(
             '{%% set submission = get_lti_submission(course_str, logged_in["email"], "%s") if logged_in is not none else none %%}' %
             self.arguments[0])
+        c.append("{% if submission is not none and submission['status'] == 'unavailable' %}"
+                 "<div class='alert alert-warning'>INGInious is currently unavailable, your answer could not be retrieved.</div>"
+                 "{% set submission = none %}"
+                 "{% endif %}")
         c.append("{% if submission is not none %}"
                  "{% for item in submission['question_answer'] %}"
                  "<div>"
@@ -182,7 +189,7 @@ class InginiousDirective(Directive):
         html_print = "\n".join(c)
 
         html = """
-        {{% if not session.get("print_mode", False) %}}
+        {{% if not print_mode %}}
         {}
         {{% else %}}
         {}
@@ -325,7 +332,7 @@ class PrintOnlyDirective(Directive):
     optional_arguments = 0
 
     def run(self):
-        sl = StringList(["{% if session.get('print_mode', True) %}"])
+        sl = StringList(["{% if print_mode is not defined or print_mode %}"])
         sl.append(StringList([""]))
         sl += self.content
         sl.append(StringList([""]))
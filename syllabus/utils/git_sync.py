@@ -0,0 +1,409 @@
+"""
+Synchronization of the pages of the courses with their git remote. The webhook only schedules a sync: it runs in a
+background thread of the worker, and the webhooks received meanwhile are coalesced into a single new sync. After a
+sync, only the compiled pages and the assets that changed between the old and the new commit are invalidated, and
+the changed pages can be compiled again right away.
+
+With git_sync.snapshots, the pages directory is not reset in place anymore. The commits are fetched in a bare
+repository (pages.git) and each synced commit is extracted in its own immutable directory (snapshots/<sha>), "pages"
+being a symbolic link to the active snapshot. A new snapshot gets the compiled pages of the previous one that are still
+valid, its other pages are compiled, then the link is replaced atomically. Every cache depending on the path of the
+pages is thus keyed by the commit.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g
+from werkzeug.security import safe_join
+
+import syllabus
+from syllabus.utils.assets import get_asset_fingerprint, is_precompressible, precompress_file, \
+    precompress_directory, precompressed_encodings
+from syllabus.utils.pages import get_pages_repo, git_fetch, git_force_sync, _render_content_to_jinja_templating
+from syllabus.utils.toc import Chapter, Page
+
+
+def get_git_sync_config():
+    git_sync_config = syllabus.get_config().get("git_sync", None) or {}
+    return {
+        "rewarm": git_sync_config.get("rewarm", True),
+        "keep_snapshots": git_sync_config.get("keep_snapshots", 3),
+    }
+
+
+@contextmanager
+def _sync_lock(course):
+    """ Prevents two workers from synchronizing the same pages directory at the same time. """
+    pages_path = os.path.abspath(syllabus.get_pages_path(course))
+    lock_path = os.path.join(tempfile.gettempdir(),
+                             "syllabus-sync-%s.lock" % hashlib.sha1(pages_path.encode("utf-8")).hexdigest()[:16])
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_head(repo):
+    try:
+        return repo.head.commit.hexsha
+    except ValueError:
+        # no commit yet
+        return None
+
+
+def get_changes(repo, old_head, new_head):
+    """
+    :return: the (status, path) tuples of the files changed between the two commits, with the paths relative to the
+    pages directory, or None if the changes are unknown
+    """
+    if old_head is None or new_head is None:
+        return None
+    if old_head == new_head:
+        return []
+    output = repo.git.diff("--name-status", "--no-renames", "-z", old_head, new_head)
+    fields = [field for field in output.split("\0") if field]
+    return list(zip(fields[0::2], fields[1::2]))
+
+
+def get_changed_contents(toc, paths):
+    """ :return: the contents of the TOC whose compiled version depends on one of the given paths """
+    paths = set(paths)
+    chapter_index_changed = "chapter_index.rst" in paths
+    return [content for content in [toc.index] + toc.ordered_content_list
+            if (type(content) is Page and content.path in paths)
+            or (type(content) is Chapter and chapter_index_changed)]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _is_asset(path):
+    return path.startswith("assets/") or "/assets/" in path
+
+
+def _refresh_asset(asset_path):
+    """ Replaces the precompressed siblings of the modified asset, or removes them if the asset has been removed. """
+    get_asset_fingerprint.manifest.pop(asset_path, None)
+    for encoding, extension in precompressed_encodings:
+        _remove(asset_path + extension)
+    try:
+        if os.path.isfile(asset_path) and is_precompressible(asset_path):
+            precompress_file(asset_path)
+    except OSError as e:
+        print("could not precompress %s: %s" % (asset_path, e), file=sys.stderr)
+
+
+def invalidate_changed_content(course, changes):
+    """
+    Removes the compiled pages and the precompressed assets that are outdated after the given changes, and reloads
+    the TOC if needed. The other workers reload their TOC when they notice that toc.yaml has been modified.
+    :param changes: the (status, path) tuples returned by get_changes, None to invalidate everything
+    :return: the contents of the TOC that have been invalidated
+    """
+    pages_path = syllabus.get_pages_path(course)
+    toc_file = os.path.join(pages_path, "toc.yaml")
+    toc = syllabus.get_toc(course)
+    if changes is None:
+        for print_mode in [False, True]:
+            shutil.rmtree(toc.cached_path(print_mode), ignore_errors=True)
+        if os.path.exists(toc_file):
+            os.utime(toc_file)
+        toc = syllabus.get_toc(course, force=True)
+        return [toc.index] + toc.ordered_content_list
+
+    paths = [path for status, path in changes]
+    if "toc.yaml" in paths or any(status in ["A", "D"] for status, path in changes):
+        # the content of the TOC depends on the existing files
+        if os.path.exists(toc_file):
+            os.utime(toc_file)
+        toc = syllabus.get_toc(course, force=True)
+
+    for path in paths:
+        if path.endswith(".rst"):
+            for cached_dir in [".cached", ".print_cached"]:
+                _remove(safe_join(pages_path, cached_dir, "%s.html" % path[:-len(".rst")]))
+        elif _is_asset(path):
+            _refresh_asset(safe_join(pages_path, path))
+    contents = get_changed_contents(toc, paths)
+    for content in contents:
+        for print_mode in [False, True]:
+            _remove(safe_join(pages_path, content.cached_path(print_mode)))
+    return contents
+
+
+def rewarm(app, course, contents=None, pages_path=None):
+    """
+    Compiles again the given contents, so that the first visitors do not wait for it.
+    :param contents: the contents to compile, all the contents of the TOC if None. The contents whose compiled version
+    is up to date are skipped.
+    :param pages_path: the snapshot of the pages to compile, the active one if None
+    """
+    if not syllabus.get_config()["caching"]["cache_pages"]:
+        return
+    with app.app_context():
+        # the directives need the course being compiled
+        g.course = course
+        if pages_path is not None:
+            g.pages_paths = {course: pages_path}
+        if contents is None:
+            toc = syllabus.get_toc(course)
+            contents = [toc.index] + toc.ordered_content_list
+        for content in contents:
+            for print_mode in [False, True]:
+                try:
+                    _render_content_to_jinja_templating(course, content, print_mode)
+                except Exception as e:
+                    print("could not compile %s: %s" % (content.path, e), file=sys.stderr)
+
+
+def sync_course(course, app=None):
+    """
+    Fetches the git remote of the course and resets its pages to the configured branch, then invalidates the content
+    that changed. Warning: the local changes will be overwritten.
+    :param app: the Flask application used to compile the changed pages again if git_sync.rewarm is enabled
+    :return: the (status, path) tuples of the changed files, None if everything has been invalidated
+    """
+    if syllabus.uses_git_snapshots(course):
+        return sync_snapshot(course, app)
+    with _sync_lock(course):
+        repo, origin, created = get_pages_repo(course)
+        old_head = _get_head(repo)
+        git_force_sync(course, origin, repo)
+        changes = get_changes(repo, old_head, _get_head(repo))
+    contents = invalidate_changed_content(course, changes)
+    if app is not None and get_git_sync_config()["rewarm"]:
+        rewarm(app, course, contents)
+    return changes
+
+
+def get_snapshots_paths(course):
+    """ :return: the paths of the bare repository, of the snapshots directory and of the link to the active snapshot """
+    link_path = os.path.abspath(syllabus.get_pages_path(course, resolve=False))
+    root = os.path.dirname(link_path)
+    return os.path.join(root, "pages.git"), os.path.join(root, "snapshots"), link_path
+
+
+def get_snapshots_repo(course):
+    """ :return: a (repo, origin) tuple, the bare repository from which the snapshots of the course are extracted """
+    from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+    repo_path, snapshots_path, link_path = get_snapshots_paths(course)
+    git_config = syllabus.get_config()['courses'][course]['pages']['git']
+    try:
+        repo = Repo(repo_path)
+    except (InvalidGitRepositoryError, NoSuchPathError):
+        repo = Repo.init(repo_path, mkdir=True, bare=True)
+    try:
+        origin = repo.remote("origin").set_url(git_config['remote'])
+    except ValueError:
+        origin = repo.create_remote("origin", git_config['remote'])
+    return repo, origin
+
+
+def get_active_snapshot(course):
+    """ :return: the commit of the active snapshot of the course, None if there is none """
+    repo_path, snapshots_path, link_path = get_snapshots_paths(course)
+    if not os.path.islink(link_path):
+        return None
+    return os.path.basename(os.readlink(link_path))
+
+
+def materialize_snapshot(repo, snapshots_path, commit):
+    """ Extracts the files of the commit in snapshots_path/<commit>, if it has not already been done. """
+    snapshot_path = os.path.join(snapshots_path, commit)
+    if os.path.isdir(snapshot_path):
+        return snapshot_path
+    os.makedirs(snapshots_path, exist_ok=True)
+    # extracted under a temporary name so that a snapshot directory is always complete
+    tmp_path = tempfile.mkdtemp(prefix=".%s-" % commit, dir=snapshots_path)
+    try:
+        with tempfile.TemporaryFile() as archive:
+            repo.archive(archive, treeish=commit, format="tar")
+            archive.seek(0)
+            with tarfile.open(fileobj=archive) as tar:
+                tar.extractall(tmp_path, **({"filter": "data"} if hasattr(tarfile, "data_filter") else {}))
+        os.chmod(tmp_path, 0o755)
+        os.rename(tmp_path, snapshot_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return snapshot_path
+
+
+def reuse_compiled_content(old_path, new_path, changes):
+    """
+    Copies in the new snapshot the compiled pages and the precompressed assets of the old snapshot that are not
+    affected by the changes, then precompresses the modified assets.
+    """
+    paths = set(path for status, path in changes)
+    # the compiled chapters all depend on chapter_index.rst
+    if "chapter_index.rst" not in paths:
+        for cached_dir in [".cached", ".print_cached"]:
+            if os.path.isdir(os.path.join(old_path, cached_dir)):
+                # copied without their modification time, so that they are more recent than their source
+                shutil.copytree(os.path.join(old_path, cached_dir), os.path.join(new_path, cached_dir),
+                                copy_function=shutil.copyfile, dirs_exist_ok=True)
+        for path in paths:
+            if path.endswith(".rst"):
+                for cached_dir in [".cached", ".print_cached"]:
+                    _remove(safe_join(new_path, cached_dir, "%s.html" % path[:-len(".rst")]))
+    for root, dirs, files in os.walk(old_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            for encoding, extension in precompressed_encodings:
+                if not name.endswith(extension):
+                    continue
+                source = os.path.relpath(os.path.join(root, name[:-len(extension)]), old_path)
+                if source not in paths and os.path.isfile(os.path.join(new_path, source)):
+                    shutil.copyfile(os.path.join(root, name), os.path.join(new_path, source + extension))
+    for path in paths:
+        if _is_asset(path):
+            _refresh_asset(safe_join(new_path, path))
+
+
+def precompress_snapshot_assets(snapshot_path):
+    """ Precompresses the assets of a snapshot that does not derive from the previous one. """
+    for root, dirs, files in os.walk(snapshot_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        if os.path.basename(root) == "assets":
+            precompress_directory(root)
+            dirs[:] = []
+
+
+def switch_snapshot(link_path, snapshot_path):
+    """ Atomically points the link of the pages to the given snapshot. """
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        # the pages were a working tree before the snapshots were enabled, they are kept aside
+        os.rename(link_path, link_path + ".before-snapshots")
+    tmp_link = "%s.%s.tmp" % (link_path, os.path.basename(snapshot_path))
+    _remove(tmp_link)
+    os.symlink(os.path.relpath(snapshot_path, os.path.dirname(link_path)), tmp_link)
+    os.replace(tmp_link, link_path)
+    # the snapshots are collected by order of activation
+    os.utime(snapshot_path)
+
+
+def collect_snapshots(snapshots_path, active_path, keep):
+    """ Removes the snapshots that have been activated the least recently, keeping the keep most recent ones. """
+    snapshots = sorted([entry for entry in os.scandir(snapshots_path) if entry.is_dir() and not entry.name.startswith(".")],
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in snapshots[max(keep, 1):]:
+        if os.path.abspath(entry.path) != os.path.abspath(active_path):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def sync_snapshot(course, app=None):
+    """
+    Fetches the git remote of the course and activates the snapshot of the configured branch, compiled beforehand if
+    an app is given and git_sync.rewarm is enabled.
+    :return: the (status, path) tuples of the files changed since the previous snapshot, None if there was none
+    """
+    from git import GitCommandError
+    git_sync_config = get_git_sync_config()
+    branch = syllabus.get_config()['courses'][course]['pages']['git']['branch']
+    repo_path, snapshots_path, link_path = get_snapshots_paths(course)
+    with _sync_lock(course):
+        repo, origin = get_snapshots_repo(course)
+        git_fetch(course, origin, repo)
+        new_head = repo.commit("refs/remotes/origin/%s" % branch).hexsha
+        old_head = get_active_snapshot(course)
+        if new_head == old_head:
+            return []
+        new_path = materialize_snapshot(repo, snapshots_path, new_head)
+        try:
+            changes = get_changes(repo, old_head, new_head)
+        except GitCommandError:
+            # the previous snapshot is not an ancestor known by the repository anymore
+            changes = None
+        if changes is not None and os.path.isdir(os.path.join(snapshots_path, old_head)):
+            reuse_compiled_content(os.path.join(snapshots_path, old_head), new_path, changes)
+        else:
+            precompress_snapshot_assets(new_path)
+        if app is not None and git_sync_config["rewarm"]:
+            rewarm(app, course, pages_path=new_path)
+        switch_snapshot(link_path, new_path)
+        collect_snapshots(snapshots_path, new_path, git_sync_config["keep_snapshots"])
+    return changes
+
+
+class SyncScheduler(object):
+    """
+    Runs the syncs of a course one at a time in a background thread. A sync requested while another one is running
+    is done once it is over, and all the requests received meanwhile are coalesced into this single sync.
+    """
+    def __init__(self, course, app=None):
+        self.course = course
+        self.app = app
+        self._lock = threading.Lock()
+        self._pending = False
+        self._running = False
+        self._stats = {"requested": 0, "coalesced": 0, "done": 0, "failed": 0}
+
+    def request(self):
+        """ Schedules a sync. :return: False if it has been coalesced with a sync that was already scheduled """
+        with self._lock:
+            self._stats["requested"] += 1
+            if self._pending:
+                self._stats["coalesced"] += 1
+                return False
+            self._pending = True
+            if self._running:
+                return True
+            self._running = True
+        threading.Thread(target=self._run, name="git-sync-%s" % self.course, daemon=True).start()
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
+            start = time.monotonic()
+            try:
+                changes = sync_course(self.course, self.app)
+            except Exception as e:
+                print("could not synchronize the pages of %s: %s" % (self.course, e), file=sys.stderr)
+                with self._lock:
+                    self._stats["failed"] += 1
+                    self._stats["last_error"] = str(e)
+                continue
+            with self._lock:
+                self._stats["done"] += 1
+                self._stats["last_duration"] = time.monotonic() - start
+                self._stats["last_changed_files"] = len(changes) if changes is not None else None
+
+    def get_stats(self):
+        """ :return: a copy of the counters of this scheduler """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["running"] = self._running
+            stats["pending"] = self._pending
+            return stats
+
+
+def get_sync_scheduler(course, app=None):
+    """ :return: the sync scheduler of the course in this process """
+    if not hasattr(get_sync_scheduler, "cached"):
+        get_sync_scheduler.cached = {}
+    if course not in get_sync_scheduler.cached:
+        get_sync_scheduler.cached.setdefault(course, SyncScheduler(course, app))
+    scheduler = get_sync_scheduler.cached[course]
+    if app is not None:
+        scheduler.app = app
+    return scheduler
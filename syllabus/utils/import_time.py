@@ -0,0 +1,58 @@
+"""
+Report of the time spent importing the syllabus when a worker starts, to keep the startup regressions visible. It
+imports the application in a fresh interpreter with "python -X importtime" and sums the time by top-level package:
+
+    python3 -m syllabus.utils.import_time [number of packages displayed]
+
+It also tells whether the heavy optional dependencies, that must only be imported when a course or an authentication
+method needs them, have been imported.
+"""
+
+import subprocess
+import sys
+
+# the optional dependencies that are imported lazily
+optional_packages = ["sphinx", "sphinxcontrib", "onelogin", "xmlsec", "git", "lti"]
+
+
+def measure_import_time(module="syllabus.inginious_syllabus"):
+    """
+    :return: the list of the (self time, cumulative time, module name, depth) of the modules imported by the given
+    module in a fresh interpreter, the times are in microseconds
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("could not import %s:\n%s" % (module, result.stderr))
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(self_time), int(cumulative), name.strip(), (len(name) - len(name.lstrip()) - 1) // 2))
+    return imports
+
+
+def get_report(imports, top=20):
+    """ :return: the report of the given imports, as a string """
+    by_package = {}
+    for self_time, cumulative, name, depth in imports:
+        package = name.split(".")[0]
+        by_package[package] = by_package.get(package, 0) + self_time
+    total = sum(self_time for self_time, cumulative, name, depth in imports)
+    lines = ["total import time: %.1f ms, %d modules" % (total / 1000, len(imports)), "",
+             "%10s  %s" % ("self [ms]", "package")]
+    for package, package_time in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append("%10.1f  %s" % (package_time / 1000, package))
+    lines.append("")
+    for package in optional_packages:
+        lines.append("%-14s %s" % (package, "imported" if package in by_package else "not imported"))
+    return "\n".join(lines)
+
+
+def print_report(top=20):
+    print(get_report(measure_import_time(), top))
+
+
+if __name__ == "__main__":
+    print_report(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,280 @@
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit, urlencode, urljoin
+
+from flask import g, has_app_context
+from werkzeug.security import safe_join
+
+import syllabus
+
+
+class INGIniousError(Exception):
+    """ Raised when INGInious could not be reached or answered with an error status. """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class INGIniousUnavailable(INGIniousError):
+    """ Raised without contacting INGInious when its circuit breaker is open or the deadline of the request is over. """
+    pass
+
+
+class INGIniousResponse(object):
+    def __init__(self, url, status, headers, data):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def text(self):
+        return self.data.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.text())
+
+
+class INGIniousClient(object):
+    """
+    HTTP client used for all the requests made to INGInious. It keeps a pool of keep-alive connections per host
+    so that the TCP and TLS handshakes are not done again for each request, and records latency and error counters.
+    Redirections are not followed: the Location header is available in the response headers.
+    """
+    # errors that can happen when a kept-alive connection has been closed by the server in the meantime
+    stale_connection_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                               BrokenPipeError)
+
+    def __init__(self, max_idle_connections=10, timeout=10, retries=1):
+        self.max_idle_connections = max_idle_connections
+        self.timeout = timeout
+        self.retries = retries
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get_connection(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle_connections.get((scheme, netloc), [])
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            connection.timeout = timeout
+            return connection, True
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        self._record("connections", "opened")
+        return connection_class(netloc, timeout=timeout), False
+
+    def _release_connection(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle_connections.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _record(self, name, counter, value=1):
+        with self._lock:
+            stats = self._stats.setdefault(name, {})
+            stats[counter] = stats.get(counter, 0) + value
+
+    def _record_latency(self, name, latency):
+        with self._lock:
+            stats = self._stats.setdefault(name, {})
+            stats["latency_total"] = stats.get("latency_total", 0) + latency
+            stats["latency_max"] = max(stats.get("latency_max", 0), latency)
+
+    def get_stats(self):
+        """ :return: a copy of the counters, by request name """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def request(self, method, url, data=None, name="other", timeout=None, retries=None):
+        """
+        Performs the request and reads the whole response.
+        :param data: a dict that will be sent url-encoded in the body of the request
+        :param name: the name under which the request is accounted in the counters
+        :param timeout: the timeout of this call, in seconds, or None to use the default one
+        :param retries: the number of times the request is retried after a timeout or a connection error, or None to use
+        the default policy. A request failing on a stale kept-alive connection is always retried once.
+        :raises INGIniousError: if INGInious could not be reached or answered with a status >= 400
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        retries = retries if retries is not None else self.retries
+        parsed = urlsplit(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        body = urlencode(data).encode() if data is not None else None
+        headers = {"Connection": "keep-alive"}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        attempt = 0
+        while True:
+            connection, reused = self._get_connection(parsed.scheme, parsed.netloc, timeout)
+            start = time.monotonic()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                resp = connection.getresponse()
+                response_data = resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused and isinstance(e, self.stale_connection_errors):
+                    # the server closed the idle connection, this attempt does not count
+                    continue
+                self._record(name, "errors")
+                if attempt < retries:
+                    attempt += 1
+                    self._record(name, "retries")
+                    continue
+                raise INGIniousError("could not reach INGInious at %s: %s" % (url, e)) from e
+            latency = time.monotonic() - start
+            self._record(name, "requests")
+            self._record_latency(name, latency)
+            if resp.will_close:
+                connection.close()
+            else:
+                self._release_connection(parsed.scheme, parsed.netloc, connection)
+            if resp.status >= 400:
+                self._record(name, "errors")
+                raise INGIniousError("INGInious answered %d for %s" % (resp.status, url), status=resp.status)
+            return INGIniousResponse(url, resp.status, dict(resp.getheaders()), response_data)
+
+    def close(self):
+        with self._lock:
+            connections = [c for idle in self._idle_connections.values() for c in idle]
+            self._idle_connections = {}
+        for connection in connections:
+            connection.close()
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to an INGInious instance after failure_threshold consecutive failures. After reset_timeout
+    seconds, a single request is let through: the breaker closes again if it succeeds, and stays open otherwise.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial_running or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial_running and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def to_dict(self):
+        return {"state": self.state, "consecutive_failures": self._failures}
+
+
+def get_circuit_breaker(course):
+    """ :return: the circuit breaker of the INGInious instance used by the given course, in this worker """
+    if not hasattr(get_circuit_breaker, "cached"):
+        get_circuit_breaker.cached = {}
+    if course not in get_circuit_breaker.cached:
+        breaker_config = (syllabus.get_config().get("inginious_client", None) or {}).get("circuit_breaker", None) or {}
+        get_circuit_breaker.cached[course] = CircuitBreaker(failure_threshold=breaker_config.get("failure_threshold", 5),
+                                                            reset_timeout=breaker_config.get("reset_timeout", 30))
+    return get_circuit_breaker.cached[course]
+
+
+def get_deadline():
+    """
+    :return: the time (as given by time.monotonic) at which the INGInious calls of the current request must be over,
+    or None if they are not bounded. It is set by the inginious_client.page_deadline configuration entry at the
+    first call of the request.
+    """
+    if not has_app_context():
+        return None
+    if "inginious_deadline" not in g:
+        deadline = (syllabus.get_config().get("inginious_client", None) or {}).get("page_deadline", 3)
+        g.inginious_deadline = time.monotonic() + deadline if deadline else None
+    return g.inginious_deadline
+
+
+def get_remaining_time(timeout):
+    """
+    Applies the deadline of the current request, that bounds the total time a page can spend waiting for INGInious.
+    :return: the timeout to use for the next INGInious call, at most timeout
+    :raises INGIniousUnavailable: if the deadline is over
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise INGIniousUnavailable("the deadline for the INGInious requests of this page is over")
+    return min(timeout, remaining) if timeout is not None else remaining
+
+
+def request_within_budget(course, method, url, name, data=None, timeout=None):
+    """
+    Performs a request to INGInious for the rendering of a page, guarded by the circuit breaker of the course and the
+    deadline of the current request. These requests are not retried.
+    :raises INGIniousError: if INGInious could not be reached, answered with an error status or is considered unavailable
+    """
+    client = get_inginious_client()
+    timeout = get_remaining_time(timeout if timeout is not None else client.timeout)
+    breaker = get_circuit_breaker(course)
+    if not breaker.allow_request():
+        raise INGIniousUnavailable("the circuit breaker of course %s is open" % course)
+    try:
+        response = client.request(method, url, data=data, name=name, timeout=timeout, retries=0)
+    except INGIniousError as e:
+        if e.status is None or e.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return response
+
+
+def get_inginious_client():
+    """
+    :return: the INGInious client of this process, configured by the inginious_client section of the configuration
+    """
+    if not hasattr(get_inginious_client, "cached"):
+        client_config = syllabus.get_config().get("inginious_client", None) or {}
+        get_inginious_client.cached = INGIniousClient(max_idle_connections=client_config.get("max_idle_connections", 10),
+                                                      timeout=client_config.get("timeout", 10),
+                                                      retries=client_config.get("retries", 1))
+    return get_inginious_client.cached
+
+
+def get_inginious_sandbox_url(course):
+    """ :return: the url of the simple grader of the INGInious course used by the given course """
+    inginious_config = syllabus.get_config()['courses'][course]['inginious']
+    path = safe_join(inginious_config.get("simple_grader_pattern", "/"), inginious_config['course_id'])
+    return urljoin(inginious_config["url"], path)
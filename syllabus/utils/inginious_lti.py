@@ -1,19 +1,113 @@
-import json
+import os
 import re
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait
 from json import JSONDecodeError
-from urllib import request as urllib_request, parse
-from urllib.error import URLError, HTTPError
+from urllib.parse import urljoin
 
-from lti import ToolConsumer
+from flask import g, has_app_context, current_app
 
 import syllabus
+from syllabus.utils.cache import SQLiteCache, get_cache_path
+from syllabus.utils.inginious_client import request_within_budget, INGIniousError, get_deadline
 
 lti_regex_match = re.compile('/@([0-9a-fA-F]+?)@/')
 
+# returned instead of the best submission when INGInious could not be queried in time
+unavailable_submission = {"status": "unavailable", "question_answer": []}
+
+
+def get_submissions_cache_config():
+    cache_config = syllabus.get_config().get("submissions_cache", None) or {}
+    return {
+        "enabled": cache_config.get("enabled", True),
+        "ttl": cache_config.get("ttl", 300),
+        "negative_ttl": cache_config.get("negative_ttl", 60),
+        "max_entries": cache_config.get("max_entries", 50000),
+        "session_ttl": cache_config.get("session_ttl", 3600),
+        "sessions_path": cache_config.get("sessions_path", None),
+    }
+
+
+def get_submissions_cache():
+    """
+    :return: the cache of the best submissions, shared by all the workers, or None if it is disabled
+    """
+    cache_config = get_submissions_cache_config()
+    if not cache_config["enabled"]:
+        return None
+    if not hasattr(get_submissions_cache, "cached"):
+        get_submissions_cache.cached = SQLiteCache(get_cache_path(), "lti_submissions",
+                                                   max_entries=cache_config["max_entries"])
+    return get_submissions_cache.cached
+
+
+def get_lti_sessions_path():
+    """
+    :return: the path of the SQLite file of the LTI session ids, set by submissions_cache.sessions_path. It defaults to
+    a file next to the shared cache file.
+    """
+    path = get_submissions_cache_config()["sessions_path"]
+    return path if path is not None else os.path.splitext(get_cache_path())[0] + "_lti_sessions.sqlite"
+
+
+def get_lti_sessions_cache():
+    """
+    :return: the cache of the LTI session ids obtained from INGInious, shared by all the workers, or None if it is
+    disabled. The session ids are INGInious session cookies: they are kept apart from the other caches, in a file only
+    readable by the user running the syllabus.
+    """
+    cache_config = get_submissions_cache_config()
+    if not cache_config["session_ttl"]:
+        return None
+    if not hasattr(get_lti_sessions_cache, "cached"):
+        path = get_lti_sessions_path()
+        # SQLite creates its journal files with the permissions of the database file
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        get_lti_sessions_cache.cached = SQLiteCache(path, "lti_sessions", max_entries=cache_config["max_entries"])
+        if os.path.abspath(path) != os.path.abspath(get_cache_path()):
+            # the previous versions kept the session ids in the shared cache file
+            try:
+                with closing(sqlite3.connect(get_cache_path(), timeout=5)) as connection:
+                    connection.execute("DROP TABLE IF EXISTS lti_sessions")
+            except sqlite3.Error:
+                pass
+    return get_lti_sessions_cache.cached
+
+
+def get_lti_session(course, user_id, task_id, relaunch=False):
+    """
+    :return: an (INGInious LTI session id, reused) tuple, reused being True if the session id comes from the cache.
+    The session id is None if INGInious refused the launch.
+    :param relaunch: set to True to ignore the cached session id, e.g. when INGInious rejected it
+    :raises INGIniousError: if INGInious could not be reached or answered with a server error
+    """
+    cache = get_lti_sessions_cache()
+    if cache is not None and not relaunch:
+        found, session_id = cache.get((course, user_id, task_id))
+        if found:
+            return session_id, True
+    try:
+        lti_url = get_lti_url(course, user_id, task_id)
+    except INGIniousError as e:
+        # a server error of INGInious is handled as if it was unreachable, only a refused launch is returned
+        if e.status is not None and e.status < 500:
+            return None, False
+        raise
+    match = lti_regex_match.findall(lti_url)
+    session_id = match[0] if len(match) == 1 else None
+    if cache is not None and session_id is not None:
+        cache.set((course, user_id, task_id), session_id, get_submissions_cache_config()["session_ttl"])
+    return session_id, False
+
 
 def get_lti_url(course, user_id, task_id):
     config = syllabus.get_config()
     inginious_config = config['courses'][course]['inginious']
+    # lti is only imported by the workers serving a course using LTI
+    from lti import ToolConsumer
     consumer = ToolConsumer(
         consumer_key=inginious_config['lti']['consumer_key'],
         consumer_secret=inginious_config['lti']['consumer_secret'],
@@ -27,12 +121,10 @@ def get_lti_url(course, user_id, task_id):
     )
 
     d = consumer.generate_launch_data()
-    data = parse.urlencode(d).encode()
-
-    req = urllib_request.Request('%s/lti/%s/%s' % (inginious_config['url'], inginious_config['course_id'], task_id), data=data)
-    resp = urllib_request.urlopen(req)
-
-    task_url = resp.geturl()
+    launch_url = '%s/lti/%s/%s' % (inginious_config['url'], inginious_config['course_id'], task_id)
+    # INGInious redirects the launch to the task url containing the LTI session id, there is no need to follow it
+    resp = request_within_budget(course, "POST", launch_url, name="lti_launch", data=d)
+    task_url = urljoin(launch_url, resp.headers.get("Location", launch_url))
 
     lti_url_regex = re.compile("%s/@[0-9a-fA-F]+@/lti/task/?" % inginious_config['url'])
     if not lti_url_regex.match(task_url):
@@ -42,27 +134,106 @@ def get_lti_url(course, user_id, task_id):
 
 
 def get_lti_submission(course, user_id, task_id):
-    config = syllabus.get_config()
+    """
+    :return: the best submission of the user for this task, or None if there is none. The result (including the absence
+    of submission) is cached for the configured time to live. If INGInious is unavailable or too slow for the deadline
+    of the current page, unavailable_submission is returned.
+    """
+    prefetched = g.get("lti_submissions", None) if has_app_context() else None
+    if prefetched is not None and (course, user_id, task_id) in prefetched:
+        return prefetched[(course, user_id, task_id)]
+    cache = get_submissions_cache()
+    if cache is not None:
+        found, submission = cache.get((course, user_id, task_id))
+        if found:
+            return submission
     try:
-        lti_url = get_lti_url(course, user_id, task_id)
-    except HTTPError:
+        submission = _fetch_lti_submission(course, user_id, task_id)
+    except INGIniousError:
+        # INGInious is unreachable or failing: do not cache this result
+        return dict(unavailable_submission)
+    if cache is None:
+        return submission
+    cache_config = get_submissions_cache_config()
+    cache.set((course, user_id, task_id), submission,
+              cache_config["ttl"] if submission is not None else cache_config["negative_ttl"])
+    return submission
+
+
+def get_prefetch_executor():
+    """
+    :return: the thread pool used to retrieve the submissions of a page concurrently, its size is set by the
+    inginious_client.max_concurrent_prefetch configuration entry
+    """
+    if not hasattr(get_prefetch_executor, "cached"):
+        client_config = syllabus.get_config().get("inginious_client", None) or {}
+        get_prefetch_executor.cached = ThreadPoolExecutor(max_workers=client_config.get("max_concurrent_prefetch", 8),
+                                                          thread_name_prefix="lti-prefetch")
+    return get_prefetch_executor.cached
+
+
+def _prefetch_lti_submission(app, deadline, course, user_id, task_id):
+    with app.app_context():
+        # the submissions are fetched within the deadline of the request that asked for them
+        g.inginious_deadline = deadline
+        return get_lti_submission(course, user_id, task_id)
+
+
+def prefetch_lti_submissions(course, user_id, task_ids):
+    """
+    Retrieves concurrently the best submissions of the user for the given tasks, so that the get_lti_submission calls
+    made afterwards during the current request do not wait for INGInious one after the other.
+    """
+    prefetched = g.setdefault("lti_submissions", {})
+    task_ids = [task_id for task_id in task_ids if (course, user_id, task_id) not in prefetched]
+    if not task_ids:
+        return
+    app = current_app._get_current_object()
+    deadline = get_deadline()
+    futures = {task_id: get_prefetch_executor().submit(_prefetch_lti_submission, app, deadline, course, user_id, task_id)
+               for task_id in task_ids}
+    wait(futures.values())
+    for task_id, future in futures.items():
+        # the unexpected errors are raised again by get_lti_submission when the page is rendered
+        if future.exception() is None:
+            prefetched[(course, user_id, task_id)] = future.result()
+
+
+def _fetch_lti_submission(course, user_id, task_id):
+    """
+    :raises INGIniousError: if INGInious could not be reached or answered with a server error
+    """
+    config = syllabus.get_config()
+    cookie, reused = get_lti_session(course, user_id, task_id)
+    if cookie is None:
+        # INGInious refused the launch
         return None
-    match = lti_regex_match.findall(lti_url)
-    if len(match) == 1:
-        cookie = match[0]
+    while True:
         try:
-            response = json.loads(urllib_request.urlopen('%s/@%s@/lti/bestsubmission' % (config['courses'][course]['inginious']['url'], cookie), timeout=5).read().decode("utf-8"))
-        except (JSONDecodeError, HTTPError):
+            response = request_within_budget(course, "GET", '%s/@%s@/lti/bestsubmission' % (config['courses'][course]['inginious']['url'], cookie),
+                                             name="lti_bestsubmission", timeout=5).json()
+        except JSONDecodeError:
             response = {"status": "error"}
+        except INGIniousError as e:
+            if e.status is None or e.status >= 500:
+                raise
+            response = {"status": "error"}
+        if response["status"] != "success" and reused:
+            # the cached session has probably expired on INGInious, launch a new one
+            cookie, reused = get_lti_session(course, user_id, task_id, relaunch=True)
+            if cookie is None:
+                return None
+            continue
         if response["status"] == "success" and response["submission"] is not None:
             return response
-    return None
+        return None
 
 
 def get_lti_data(course, user_id, task_id):
     course_config = syllabus.get_config()['courses'][course]
     inginious_config = course_config['inginious']
     lti_config = inginious_config['lti']
+    from lti import ToolConsumer
     consumer = ToolConsumer(
         consumer_key=inginious_config['lti']['consumer_key'],
         consumer_secret=inginious_config['lti']['consumer_secret'],
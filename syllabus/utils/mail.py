@@ -3,14 +3,18 @@ import smtplib
 from email.message import EmailMessage
 
 
-def _send_confirmation_email(email_from, email_to, url, serv):
+def get_confirmation_email(email_from, email_to, url):
     msg = EmailMessage()
     msg['Subject'] = "syllabus registration confirmation"
     msg['From'] = email_from
     msg['To'] = email_to
 
     msg.set_content("You can confirm your registration by clicking on the following link: {}".format(url))
-    serv.send_message(msg)
+    return msg
+
+
+def _send_confirmation_email(email_from, email_to, url, serv):
+    serv.send_message(get_confirmation_email(email_from, email_to, url))
 
 
 def send_confirmation_mail(email_from, email_to, url, smtp_server, smtp_port=None, use_ssl=True):
@@ -0,0 +1,240 @@
+"""
+Persistent queue of the outgoing e-mails.
+
+The requests only insert the e-mails in a SQLite table. They are sent by a background thread of the workers, or by a
+separate process when mail_queue.background_sender is disabled:
+
+    python3 -m syllabus.utils.mail_queue
+
+The sender keeps its SMTP connection open between the e-mails and retries the failed ones with an exponential
+backoff. It can be tested against a local SMTP stand-in, e.g. "python3 -m aiosmtpd -n -l localhost:8025" with
+use_ssl set to no, smtp_server_port set to 8025 and the authentication disabled.
+"""
+
+import os
+import smtplib
+import sqlite3
+import sys
+import threading
+import time
+
+import syllabus
+from syllabus.utils.mail import get_confirmation_email
+
+
+def get_mail_queue_config():
+    queue_config = syllabus.get_config().get("mail_queue", None) or {}
+    path = queue_config.get("path", None)
+    return {
+        "path": path if path is not None else os.path.join(syllabus.get_root_path(), "mail_queue.sqlite"),
+        "background_sender": queue_config.get("background_sender", True),
+        "max_attempts": queue_config.get("max_attempts", 5),
+        "retry_delay": queue_config.get("retry_delay", 30),
+        "idle_timeout": queue_config.get("idle_timeout", 30),
+    }
+
+
+def get_smtp_config():
+    """ :return: the SMTP settings of the e-mail activation, used for all the e-mails sent by the syllabus """
+    activation_config = syllabus.get_config()["authentication_methods"]["local"]["email_activation"]
+    auth_config = activation_config.get("authentication", None) or {}
+    authenticated = auth_config.get("required", False)
+    return {
+        "server": activation_config["smtp_server"],
+        "port": activation_config.get("smtp_server_port", None),
+        # the authenticated e-mails have always been sent over SSL
+        "use_ssl": authenticated or activation_config.get("use_ssl", True),
+        "username": auth_config["username"] if authenticated else None,
+        "password": auth_config["password"] if authenticated else None,
+    }
+
+
+class MailQueue(object):
+    """
+    The e-mails waiting to be sent, stored in a SQLite database shared by all the workers. A message is claimed by a
+    sender before being sent so that it is never sent twice by two workers.
+    """
+    # number of seconds after which a message claimed by a sender that died can be claimed again
+    claim_timeout = 300
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._get_connection().execute("CREATE TABLE IF NOT EXISTS mail_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                       "email_from TEXT NOT NULL, email_to TEXT NOT NULL, message TEXT NOT NULL, "
+                                       "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                                       "claimed_until REAL NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+                                       "last_error TEXT)")
+        self._get_connection().execute("CREATE INDEX IF NOT EXISTS mail_queue_pending "
+                                       "ON mail_queue (failed, next_attempt)")
+
+    def _get_connection(self):
+        # sqlite3 connections cannot be shared between threads, nor with the processes forked after their opening
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def put(self, email_from, email_to, message):
+        """ Adds the given EmailMessage to the queue. """
+        self._get_connection().execute("INSERT INTO mail_queue (email_from, email_to, message, next_attempt) "
+                                       "VALUES (?, ?, ?, ?)", (email_from, email_to, message.as_string(), time.time()))
+
+    def claim(self, limit=50):
+        """ :return: the (id, email_from, email_to, message, attempts) tuples of the messages to send now """
+        connection = self._get_connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute("SELECT id, email_from, email_to, message, attempts FROM mail_queue "
+                                      "WHERE failed = 0 AND next_attempt <= ? AND claimed_until <= ? "
+                                      "ORDER BY next_attempt LIMIT ?", (now, now, limit)).fetchall()
+            connection.executemany("UPDATE mail_queue SET claimed_until = ? WHERE id = ?",
+                                   [(now + self.claim_timeout, row[0]) for row in rows])
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        return rows
+
+    def done(self, message_id):
+        self._get_connection().execute("DELETE FROM mail_queue WHERE id = ?", (message_id,))
+
+    def retry(self, message_id, attempts, error, max_attempts, retry_delay):
+        """ Schedules a new attempt for the message, or marks it as failed after max_attempts attempts. """
+        self._get_connection().execute("UPDATE mail_queue SET attempts = ?, next_attempt = ?, claimed_until = 0, "
+                                       "failed = ?, last_error = ? WHERE id = ?",
+                                       (attempts, time.time() + retry_delay * 2 ** (attempts - 1),
+                                        1 if attempts >= max_attempts else 0, str(error), message_id))
+
+    def get_stats(self):
+        """ :return: the number of pending and failed messages """
+        pending, failed = self._get_connection().execute("SELECT COUNT(*) - COALESCE(SUM(failed), 0), "
+                                                         "COALESCE(SUM(failed), 0) FROM mail_queue").fetchone()
+        return {"pending": pending, "failed": failed}
+
+
+class MailSender(object):
+    """ Sends the queued e-mails, reusing the same SMTP connection as long as there are e-mails to send. """
+    poll_interval = 5
+
+    def __init__(self, queue, max_attempts=5, retry_delay=30, idle_timeout=30):
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.wakeup = threading.Event()
+        self._smtp = None
+        self._last_used = 0
+
+    def _connect(self):
+        smtp_config = get_smtp_config()
+        smtp_type = smtplib.SMTP_SSL if smtp_config["use_ssl"] else smtplib.SMTP
+        # port 0 == default port (465 for ssl, 25 for unencrypted)
+        smtp = smtp_type(smtp_config["server"], port=smtp_config["port"] if smtp_config["port"] is not None else 0,
+                         timeout=30)
+        if smtp_config["username"] is not None:
+            smtp.login(smtp_config["username"], smtp_config["password"])
+        return smtp
+
+    def _close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def _send(self, email_from, email_to, message):
+        for reconnect in [False, True]:
+            if self._smtp is None:
+                self._smtp = self._connect()
+            try:
+                self._smtp.sendmail(email_from, [email_to], message.encode("utf-8"))
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # the server closed the connection we kept open
+                self._smtp = None
+                if reconnect:
+                    raise
+
+    def send_pending(self):
+        """ Sends all the e-mails whose time has come. :return: the number of e-mails handled """
+        rows = self.queue.claim()
+        for message_id, email_from, email_to, message, attempts in rows:
+            try:
+                self._send(email_from, email_to, message)
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                self.queue.retry(message_id, attempts + 1, e, self.max_attempts, self.retry_delay)
+                print("could not send an e-mail to %s: %s" % (email_to, e), file=sys.stderr)
+                continue
+            self.queue.done(message_id)
+        return len(rows)
+
+    def run(self):
+        while True:
+            try:
+                handled = self.send_pending()
+            except sqlite3.Error as e:
+                print("could not read the mail queue: %s" % e, file=sys.stderr)
+                handled = 0
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._close()
+            if not handled:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+
+def get_mail_queue():
+    """ :return: the mail queue of this process, configured by the mail_queue configuration section """
+    if not hasattr(get_mail_queue, "cached"):
+        get_mail_queue.cached = MailQueue(get_mail_queue_config()["path"])
+    return get_mail_queue.cached
+
+
+def get_mail_sender():
+    """ :return: the mail sender of this process """
+    if not hasattr(get_mail_sender, "cached"):
+        queue_config = get_mail_queue_config()
+        get_mail_sender.cached = MailSender(get_mail_queue(), max_attempts=queue_config["max_attempts"],
+                                            retry_delay=queue_config["retry_delay"],
+                                            idle_timeout=queue_config["idle_timeout"])
+    return get_mail_sender.cached
+
+
+def start_background_sender():
+    """
+    Starts the thread sending the queued e-mails in this process, if it is enabled and not already running. The
+    thread is not inherited by the workers forked from this process, each of them starts its own.
+    """
+    if start_background_sender.pid == os.getpid():
+        return
+    with start_background_sender.lock:
+        if start_background_sender.pid == os.getpid():
+            return
+        if get_mail_queue_config()["background_sender"]:
+            start_background_sender.thread = threading.Thread(target=get_mail_sender().run, name="mail-sender",
+                                                              daemon=True)
+            start_background_sender.thread.start()
+        start_background_sender.pid = os.getpid()
+
+
+start_background_sender.lock = threading.Lock()
+start_background_sender.pid = None
+
+
+def queue_confirmation_mail(email_from, email_to, url):
+    """ Queues the registration confirmation e-mail, it is sent in the background. """
+    get_mail_queue().put(email_from, email_to, get_confirmation_email(email_from, email_to, url))
+    start_background_sender()
+    get_mail_sender().wakeup.set()
+
+
+if __name__ == "__main__":
+    print("Sending the e-mails queued in %s" % get_mail_queue_config()["path"], file=sys.stderr)
+    get_mail_sender().run()
@@ -17,18 +17,22 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import re
+import time
 from functools import wraps
 
 import yaml
 from docutils.core import publish_string
 from flask import render_template_string, redirect, session, abort, request
 from werkzeug.security import safe_join
-from git import Repo, InvalidGitRepositoryError
 from werkzeug.utils import secure_filename
 
 import syllabus
 from syllabus.models.user import User
+from syllabus.utils.assets import fingerprint_urls, minify_html
+from syllabus.utils.cache import get_cache_path
 from syllabus.utils.feedbacks import set_feedback
+from syllabus.utils.inginious_lti import prefetch_lti_submissions
 from syllabus.utils.toc import Chapter, Content, Page
 
 default_rst_opts = {
@@ -41,6 +45,9 @@ default_rst_opts = {
     'halt_level': 5
 }
 
+# the call emitted by the inginious directive in the compiled pages
+lti_submission_call_regex = re.compile(r'get_lti_submission\(course_str, logged_in\["email"\], "([^"]+)"\)')
+
 
 def seeother(link, feedback=None):
     if feedback is not None:
@@ -69,20 +76,73 @@ def sanitize_path(f):
     return wrapper
 
 
+def get_rights_generation_path():
+    """
+    :return: the path of the file whose modification tells the workers that a right has changed. It is next to the
+    shared cache file.
+    """
+    return get_cache_path() + ".rights"
+
+
+def _get_rights_generation():
+    try:
+        stat = os.stat(get_rights_generation_path())
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_user_right(email):
+    """
+    :return: the right of the user with the given email, None if the user has no right or does not exist. It is kept
+    in memory for caching.rights_ttl seconds, invalidate_user_right must be called when it is modified: the rights
+    kept by all the workers are then discarded, which only costs a stat of the generation file per request.
+    """
+    rights_ttl = syllabus.get_config()["caching"].get("rights_ttl", 60)
+    if rights_ttl:
+        generation = _get_rights_generation()
+        if generation != get_user_right.generation or len(get_user_right.cached) > get_user_right.max_entries:
+            get_user_right.cached = {}
+            get_user_right.generation = generation
+        cached = get_user_right.cached.get(email, None)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+    user = User.query.filter(User.email == email).first()
+    right = user.right if user is not None else None
+    if rights_ttl:
+        get_user_right.cached[email] = (right, time.monotonic() + rights_ttl)
+    return right
+
+
+get_user_right.cached = {}
+get_user_right.generation = None
+get_user_right.max_entries = 10000
+
+
+def invalidate_user_right(email):
+    """ Discards the right of the user kept by this worker, and tells the other workers to discard theirs. """
+    get_user_right.cached.pop(email, None)
+    # the size changes as well, in case two invalidations happen within the resolution of the modification time
+    generation = _get_rights_generation()
+    with open(get_rights_generation_path(), "a" if generation is None or generation[1] < 4096 else "w") as f:
+        f.write("\n")
+
+
 def permission_admin(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         email = session["user"]["email"] if "user" in session else None
         if email is None:
             abort(403)
-        user = User.query.filter(User.email == email).first()
-        if not user.admin:
+        if get_user_right(email) != "admin":
             abort(403)
         return f(*args, **kwargs)
     return wrapper
 
 def store_last_visited():
-    session['last_visited'] = request.path
+    # only modified when it changes so that reloading a page does not send the session cookie again
+    if session.get('last_visited', None) != request.path:
+        session['last_visited'] = request.path
 
 def update_last_visited(f):
     @wraps(f)
@@ -94,22 +154,22 @@ def update_last_visited(f):
 def get_cheat_sheet():
     with open(os.path.join(syllabus.get_root_path(), 'cheat_sheet/rst-cheatsheet.rst'), "r") as f:
         code_html = render_template_string(publish_string(f.read(),
-                              writer_name='html', settings_overrides=default_rst_opts))
+                              writer_name='html', settings_overrides=default_rst_opts), print_mode=False)
         return "<div id=\"cheat_sheet\" style=\"overflow-y: scroll\">"+code_html+"</div>"
 
-def _render_content_to_jinja_templating(course, content):
+def _render_content_to_jinja_templating(course, content, print_mode=False):
     if type(content) is Chapter:
-        return _render_rst_to_jinja_templating(course, "chapter_index.rst", content)
+        return _render_rst_to_jinja_templating(course, "chapter_index.rst", content, print_mode)
     else:
-        return _render_rst_to_jinja_templating(course, content.path, content)
+        return _render_rst_to_jinja_templating(course, content.path, content, print_mode)
 
 
-def render_content(course, content, **kwargs):
+def render_content(course, content, print_mode=False, **kwargs):
     if type(content) is Chapter:
-        return render_rst_file(course, "chapter_index.rst", content, chapter_path=content.path,
+        return render_rst_file(course, "chapter_index.rst", content, print_mode, chapter_path=content.path,
                                chapter_desc=get_chapter_intro(course, content), **kwargs)
     else:
-        return render_rst_file(course, content.path, content, **kwargs)
+        return render_rst_file(course, content.path, content, print_mode, **kwargs)
 
 def render_footer(course):
     try:
@@ -124,10 +184,9 @@ def render_rst_str(str_to_render: str, type="normal"):
     return publish_string(str_to_render, writer_name='html', settings_overrides=default_rst_opts)
 
 
-def _render_rst_to_jinja_templating(course, page_path, content):
+def _render_rst_to_jinja_templating(course, page_path, content, print_mode=False):
     cache_pages = syllabus.get_config()["caching"]["cache_pages"]
     toc = syllabus.get_toc(course)
-    print_mode = session.get("print_mode", False)
     # look if we have a cached version of this content
     if cache_pages and toc.has_cached_content(content, print_mode):
         with open(safe_join(syllabus.get_pages_path(course), content.cached_path(print_mode)), "r") as f:
@@ -136,6 +195,8 @@ def _render_rst_to_jinja_templating(course, page_path, content):
         # render the content
         with open(safe_join(syllabus.get_pages_path(course), page_path), "r") as f:
             rendered = publish_string(f.read(), writer_name='html', settings_overrides=default_rst_opts)
+        if syllabus.get_config()["caching"].get("minify_pages", False):
+            rendered = minify_html(rendered)
         if cache_pages:  # cache the content if needed
             if type(content) is Page:
                 parent = toc.get_parent_of(content)
@@ -145,11 +206,55 @@ def _render_rst_to_jinja_templating(course, page_path, content):
                 os.makedirs(safe_join(toc.cached_path(print_mode), content.path), exist_ok=True)
             with open(safe_join(syllabus.get_pages_path(course), content.cached_path(print_mode)), "w") as cached_content:
                 cached_content.write(rendered)
+    index_task_ids(course, page_path, content, rendered)
     return rendered
 
 
-def render_rst_file(course, page_path, content, **kwargs):
-    return render_template_string(_render_rst_to_jinja_templating(course, page_path, content), **kwargs)
+def index_task_ids(course, page_path, content, rendered):
+    """
+    Records the INGInious tasks whose submission is displayed by the compiled content. The index is only updated
+    when the source of the content has been modified.
+    """
+    # the path of the source differs between the git snapshots of the pages
+    source_path = safe_join(syllabus.get_pages_path(course), page_path)
+    version = (source_path, os.path.getmtime(source_path))
+    indexed = get_task_ids.index.get((course, content.path), None)
+    if indexed is None or indexed[0] != version:
+        get_task_ids.index[(course, content.path)] = (version, list(dict.fromkeys(lti_submission_call_regex.findall(rendered))))
+
+
+def get_task_ids(course, content):
+    """ :return: the ids of the INGInious tasks of the given content, as indexed when it was last compiled """
+    indexed = get_task_ids.index.get((course, content.path), None)
+    return indexed[1] if indexed is not None else []
+
+
+get_task_ids.index = {}
+
+
+def prefetch_submissions(course, contents, print_mode=False):
+    """
+    Retrieves concurrently the submissions that will be displayed by the given contents if they are printed. The print
+    views call it with all the printed contents before rendering them, so that the submissions of all the pages are
+    requested at once.
+    """
+    if not print_mode or "user" not in session \
+            or "lti" not in syllabus.get_config()['courses'][course]['inginious']:
+        return
+    task_ids = []
+    for content in contents:
+        if (course, content.path) not in get_task_ids.index:
+            # the task ids of a content are indexed when it is compiled or read from the cache
+            _render_content_to_jinja_templating(course, content, print_mode)
+        task_ids += get_task_ids(course, content)
+    prefetch_lti_submissions(course, session["user"]["email"], list(dict.fromkeys(task_ids)))
+
+
+def render_rst_file(course, page_path, content, print_mode=False, **kwargs):
+    template = _render_rst_to_jinja_templating(course, page_path, content, print_mode)
+    prefetch_submissions(course, [content], print_mode)
+    # the fingerprints are added after rendering so that the cached pages always reference the current assets
+    return fingerprint_urls(render_template_string(template, print_mode=print_mode, **kwargs))
 
 
 def get_content_data(course, content: Content):
@@ -180,14 +285,14 @@ def generate_toc_yaml(course):
     return str(yaml.dump(result))
 
 
-def init_and_sync_repo(course, force_sync=False):
+def get_pages_repo(course):
     """
-    Initializes a git repository in the pages folder if no repository already exists, then
-    synchronizes it with the remote specified in the configuration file if the
-    origin didn't exist before or if force_sync is True.
-    Warning: the local changes will be overwritten.
-    :return:
+    Initializes a git repository in the pages folder if no repository already exists, and points its origin to the
+    remote specified in the configuration file.
+    :return: a (repo, origin, created) tuple, created is True if the origin didn't exist before
     """
+    # git is only imported by the workers serving a course synchronized with git
+    from git import Repo, InvalidGitRepositoryError
     path = os.path.join(syllabus.get_root_path(), syllabus.get_pages_path(course))
     git_config = syllabus.get_config()['courses'][course]['pages']['git']
     try:
@@ -199,19 +304,36 @@ def init_and_sync_repo(course, force_sync=False):
         repo = Repo.init(path)
     try:
         origin = repo.remote("origin").set_url(git_config['remote'])
+        created = False
     except:
         origin = repo.create_remote("origin", git_config['remote'])
+        created = True
+    return repo, origin, created
+
+
+def init_and_sync_repo(course, force_sync=False):
+    """
+    Initializes a git repository in the pages folder if no repository already exists, then
+    synchronizes it with the remote specified in the configuration file if the
+    origin didn't exist before or if force_sync is True.
+    Warning: the local changes will be overwritten.
+    :return:
+    """
+    # imported here as the sync module depends on this one
+    from syllabus.utils.git_sync import sync_course
+    if force_sync or syllabus.uses_git_snapshots(course):
+        sync_course(course)
+    else:
+        repo, origin, created = get_pages_repo(course)
         # sync the repo if the origin wasn't already there
-        force_sync = True
-    if force_sync:
-        git_force_sync(course, origin, repo)
-        syllabus.get_toc(course, True)
+        if created:
+            sync_course(course)
 
 
-def git_force_sync(course, origin, repo):
+def git_fetch(course, origin, repo):
+    """ Fetches the origin of the repository, with the deployment key of the course if there is one. """
     git_config = syllabus.get_config()['courses'][course]['pages']['git']
     private_key_path = git_config['repository_private_key']
-    branch = git_config['branch']
     if private_key_path is not None:
         # We need to be compatible with git < 2.3 as CentOS7 uses an older version, so here is an ugly code
         # to use a deployment key that will work with old git versions
@@ -223,14 +345,15 @@ def git_force_sync(course, origin, repo):
         os.system("chmod +x %s" % ssh_executable_path)
         with repo.git.custom_environment(GIT_SSH=ssh_executable_path):
             origin.fetch()
-            # complete synchronization (local changes will be overwritten)
-            repo.git.reset('--hard', 'origin/%s' % branch)
         # Hereunder is a more pretty version, uncomment it when the git version is >= 2.3
         # with repo.git.custom_environment(GIT_SSH_COMMAND='ssh -i %s -o StrictHostKeyChecking=no' % private_key_path):
         #     origin.fetch()
-        #     # complete synchronization (local changes will be overwritten)
-        #     repo.git.reset('--hard', 'origin/%s' % branch)
     else:
         origin.fetch()
-        # complete synchronization (local changes will be overwritten)
-        repo.git.reset('--hard', 'origin/%s' % branch)
+
+
+def git_force_sync(course, origin, repo):
+    branch = syllabus.get_config()['courses'][course]['pages']['git']['branch']
+    git_fetch(course, origin, repo)
+    # complete synchronization (local changes will be overwritten)
+    repo.git.reset('--hard', 'origin/%s' % branch)
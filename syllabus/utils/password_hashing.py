@@ -0,0 +1,178 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import syllabus
+from syllabus.models.user import hash_password_func
+from syllabus.utils.cache import SQLiteCache, get_cache_path
+
+
+class PasswordHashingRefused(Exception):
+    """ Raised when a password cannot be hashed now. The message can be displayed to the user. """
+    pass
+
+
+class TooManyAttempts(PasswordHashingRefused):
+    pass
+
+
+class HashingOverloaded(PasswordHashingRefused):
+    pass
+
+
+def get_password_hashing_config():
+    hashing_config = syllabus.get_config().get("password_hashing", None) or {}
+    throttling_config = hashing_config.get("throttling", None) or {}
+    return {
+        "processes": hashing_config.get("processes", 2),
+        "max_queued": hashing_config.get("max_queued", 50),
+        "queue_timeout": hashing_config.get("queue_timeout", 10),
+        "window": throttling_config.get("window", 60),
+        "max_attempts_per_ip": throttling_config.get("max_attempts_per_ip", 0),
+        "max_attempts_per_account": throttling_config.get("max_attempts_per_account", 10),
+    }
+
+
+class PasswordHasher(object):
+    """
+    Hashes the passwords in a pool of processes so that a burst of logins only keeps these processes busy, and not
+    all the threads serving the pages. At most max_queued hashes can wait for a free process, for at most queue_timeout
+    seconds. With 0 processes, the passwords are hashed by the calling thread, with the same concurrency limit.
+    """
+    def __init__(self, processes=2, max_queued=50, queue_timeout=10):
+        self.processes = processes
+        self.queue_timeout = queue_timeout
+        self._executor = ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+        self._slots = threading.BoundedSemaphore(max(processes, 1) + max_queued)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _record(self, counter, value=1):
+        with self._lock:
+            self._stats[counter] = self._stats.get(counter, 0) + value
+
+    def _record_max(self, counter, value):
+        with self._lock:
+            self._stats[counter] = max(self._stats.get(counter, 0), value)
+
+    def get_stats(self):
+        """ :return: a copy of the counters of this hasher """
+        with self._lock:
+            return dict(self._stats)
+
+    def hash(self, email, password, global_salt, n_iterations):
+        """
+        :return: the result of hash_password_func for these arguments
+        :raises HashingOverloaded: if too many passwords are already waiting to be hashed
+        :raises UnicodeEncodeError: if the password cannot be encoded
+        """
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._record("rejected")
+            raise HashingOverloaded("The server is busy, please try again in a few seconds.")
+        try:
+            if self._executor is not None:
+                future = self._executor.submit(hash_password_func, email, password, global_salt, n_iterations)
+                result = future.result()
+            else:
+                result = hash_password_func(email, password, global_salt, n_iterations)
+        finally:
+            self._slots.release()
+        latency = time.monotonic() - start
+        self._record("hashed")
+        self._record("latency_total", latency)
+        self._record_max("latency_max", latency)
+        return result
+
+
+    def hash_many(self, emails, passwords, global_salt, n_iterations):
+        """
+        Hashes a batch of passwords, e.g. of imported users, in the same pool as the logins. The batch takes a single
+        slot and is submitted a few passwords at a time, so that the logins are hashed in between.
+        :return: the list of the results of hash_password_func, in the order of the given passwords
+        :raises HashingOverloaded: if too many passwords are already waiting to be hashed
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._record("rejected")
+            raise HashingOverloaded("The server is busy, please try again in a few seconds.")
+        try:
+            if self._executor is None:
+                results = [hash_password_func(email, password, global_salt, n_iterations)
+                           for email, password in zip(emails, passwords)]
+            else:
+                results = []
+                for i in range(0, len(emails), self.processes):
+                    futures = [self._executor.submit(hash_password_func, email, password, global_salt, n_iterations)
+                               for email, password in zip(emails[i:i + self.processes], passwords[i:i + self.processes])]
+                    results += [future.result() for future in futures]
+        finally:
+            self._slots.release()
+        self._record("hashed", len(results))
+        return results
+
+
+def get_password_hasher():
+    """ :return: the password hasher of this process, configured by the password_hashing configuration section """
+    if not hasattr(get_password_hasher, "cached"):
+        hashing_config = get_password_hashing_config()
+        get_password_hasher.cached = PasswordHasher(processes=hashing_config["processes"],
+                                                    max_queued=hashing_config["max_queued"],
+                                                    queue_timeout=hashing_config["queue_timeout"])
+    return get_password_hasher.cached
+
+
+def get_attempts_cache():
+    """ :return: the counters of the recent hashing attempts, shared by all the workers """
+    if not hasattr(get_attempts_cache, "cached"):
+        get_attempts_cache.cached = SQLiteCache(get_cache_path(), "hashing_attempts")
+    return get_attempts_cache.cached
+
+
+def _is_throttled(key, max_attempts):
+    """ :return: True if there were already max_attempts failed attempts for the key during the current window """
+    if not max_attempts:
+        return False
+    found, failures = get_attempts_cache().get(key)
+    return found and failures >= max_attempts
+
+
+def throttle(client_ip, email=None):
+    """
+    Checks the recent failed login attempts of the client address and of the account.
+    :raises TooManyAttempts: if one of them failed too many times recently
+    """
+    hashing_config = get_password_hashing_config()
+    throttled = _is_throttled(("ip", client_ip), hashing_config["max_attempts_per_ip"])
+    if not throttled and email is not None:
+        throttled = _is_throttled(("account", email), hashing_config["max_attempts_per_account"])
+    if throttled:
+        get_password_hasher()._record("throttled")
+        raise TooManyAttempts("Too many attempts, please try again in a minute.")
+
+
+def record_failed_attempt(client_ip, email):
+    """ Counts a failed login attempt for the client address and the account, the successful ones are not counted. """
+    hashing_config = get_password_hashing_config()
+    cache = get_attempts_cache()
+    if hashing_config["max_attempts_per_ip"]:
+        cache.increment(("ip", client_ip), hashing_config["window"])
+    if hashing_config["max_attempts_per_account"]:
+        cache.increment(("account", email), hashing_config["window"])
+
+
+def hash_password(email, password, client_ip=None):
+    """
+    Hashes the password of the account as configured by password_salt and password_hash_iterations.
+    :param client_ip: the address of the client, the hash is refused if the address or the account recently failed to
+    log in too many times
+    :raises PasswordHashingRefused: if the attempt is throttled or the server is overloaded
+    :raises UnicodeEncodeError: if the password cannot be encoded
+    """
+    if client_ip is not None:
+        throttle(client_ip, email)
+    global_salt = syllabus.get_config().get('password_salt', None)
+    n_iterations = syllabus.get_config().get('password_hash_iterations', 100000)
+    if global_salt is None:
+        # a single sha512, not worth a trip to the pool
+        return hash_password_func(email, password, global_salt, n_iterations)
+    return get_password_hasher().hash(email, password, global_salt, n_iterations)
@@ -0,0 +1,309 @@
+"""
+Server-side sessions. By default, the whole session is stored in the signed cookie that is sent back and forth with
+each request. When sessions.backend is set, the cookie only contains a random session id, signed with the
+sessions_secret_key, and the content of the session is kept by the syllabus:
+
+- sqlite: in a table of a SQLite file shared by all the workers (the shared_cache_path file by default)
+- redis: in a Redis server, or any key-value server speaking its protocol. An in-memory stand-in can be started
+  for local tests with "python3 -m syllabus.utils.sessions 6379".
+
+A session is only read from the store when the request handler uses it, so serving an asset never touches the store.
+"""
+
+import json
+import os
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+
+import syllabus
+from syllabus.utils.cache import SQLiteCache, get_cache_path
+
+
+class SessionStoreError(Exception):
+    pass
+
+
+def get_sessions_config():
+    sessions_config = syllabus.get_config().get("sessions", None) or {}
+    return {
+        "backend": sessions_config.get("backend", None),
+        "ttl": sessions_config.get("ttl", 604800),
+        "path": sessions_config.get("path", None),
+        "max_entries": sessions_config.get("max_entries", 1000000),
+        "host": sessions_config.get("host", "localhost"),
+        "port": sessions_config.get("port", 6379),
+        "timeout": sessions_config.get("timeout", 2),
+        "key_prefix": sessions_config.get("key_prefix", "syllabus:session:"),
+    }
+
+
+class SQLiteSessionStore(object):
+    """ Stores the sessions in a SQLite file shared by all the workers. """
+    def __init__(self, path, max_entries=1000000):
+        self._cache = SQLiteCache(path, "sessions", max_entries=max_entries)
+
+    def get(self, sid):
+        found, value = self._cache.get((sid,))
+        return value if found else None
+
+    def set(self, sid, value, ttl):
+        self._cache.set((sid,), value, ttl)
+
+    def delete(self, sid):
+        self._cache.delete((sid,))
+
+
+def _encode_command(args):
+    encoded = [arg if isinstance(arg, bytes) else str(arg).encode("utf-8") for arg in args]
+    return b"*%d\r\n" % len(encoded) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in encoded)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("the connection to the session store was closed")
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload.decode("utf-8")
+    if prefix == b"-":
+        raise SessionStoreError(payload.decode("utf-8"))
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("the connection to the session store was closed")
+        return data[:-2]
+    if prefix == b"*":
+        length = int(payload)
+        return None if length < 0 else [_read_reply(reader) for _ in range(length)]
+    raise SessionStoreError("unexpected reply from the session store: %r" % line)
+
+
+class RedisSessionStore(object):
+    """ Stores the sessions in a Redis server. Each thread keeps its own connection open. """
+    def __init__(self, host, port, timeout=2, key_prefix="syllabus:session:"):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self._local = threading.local()
+
+    def _get_connection(self):
+        # a socket opened before a fork must not be shared with the forked workers
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            connection = (sock, sock.makefile("rb"))
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _command(self, *args):
+        # the connection kept open may have been closed by the server, the commands used here can be sent again
+        for retry in [False, True]:
+            sock, reader = self._get_connection()
+            try:
+                sock.sendall(_encode_command(args))
+                return _read_reply(reader)
+            except OSError:
+                self._close()
+                if retry:
+                    raise
+
+    def get(self, sid):
+        value = self._command("GET", self.key_prefix + sid)
+        return json.loads(value) if value is not None else None
+
+    def set(self, sid, value, ttl):
+        self._command("SET", self.key_prefix + sid, json.dumps(value), "EX", max(1, int(ttl)))
+
+    def delete(self, sid):
+        self._command("DEL", self.key_prefix + sid)
+
+
+def get_session_store():
+    """ :return: the session store of this process, as configured by the sessions configuration section """
+    if not hasattr(get_session_store, "cached"):
+        sessions_config = get_sessions_config()
+        if sessions_config["backend"] == "sqlite":
+            path = sessions_config["path"]
+            get_session_store.cached = SQLiteSessionStore(path if path is not None else get_cache_path(),
+                                                          max_entries=sessions_config["max_entries"])
+        elif sessions_config["backend"] == "redis":
+            get_session_store.cached = RedisSessionStore(sessions_config["host"], sessions_config["port"],
+                                                         timeout=sessions_config["timeout"],
+                                                         key_prefix=sessions_config["key_prefix"])
+        else:
+            raise ValueError("unknown sessions backend: %s" % sessions_config["backend"])
+    return get_session_store.cached
+
+
+class ServerSideSession(SessionMixin):
+    """ A session whose content is only read from the store the first time it is used. """
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        # set when the user logs in or out, so that a session id known before cannot be used afterwards
+        self.rotate = False
+        self.refresh = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _load(self):
+        if self._data is None:
+            self.accessed = True
+            stored = None
+            if self.sid is not None:
+                try:
+                    stored = self.store.get(self.sid)
+                except (OSError, SessionStoreError) as e:
+                    print("could not read the session: %s" % e, file=sys.stderr)
+            if stored is None:
+                self.sid = None
+                self.new = True
+                self._data = {}
+            else:
+                self._data = ServerSideSessionInterface.serializer.loads(stored["data"])
+                self.refresh = time.time() - stored["saved_at"] > get_sessions_config()["ttl"] / 2
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+        self.rotate = self.rotate or key == "user"
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+        self.rotate = self.rotate or key == "user"
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """ Keeps the content of the sessions in a store, the cookie only contains the signed id of the session. """
+    serializer = TaggedJSONSerializer()
+    salt = "syllabus-session-id"
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def _get_signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        sid = None
+        cookie = request.cookies.get(self.get_cookie_name(app), None)
+        if cookie is not None:
+            try:
+                sid = self._get_signer(app).unsign(cookie).decode("ascii")
+            except (BadSignature, UnicodeDecodeError):
+                sid = None
+        return ServerSideSession(self.store, sid)
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            # the request did not use the session, e.g. an asset
+            return
+        response.vary.add("Cookie")
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        try:
+            if (session.rotate or not session) and session.sid is not None:
+                self.store.delete(session.sid)
+                session.sid = None
+            if not session:
+                if session.modified and not session.new:
+                    response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                           samesite=self.get_cookie_samesite(app),
+                                           httponly=self.get_cookie_httponly(app))
+                return
+            if not session.modified and not session.refresh:
+                return
+            new_sid = session.sid is None
+            if new_sid:
+                session.sid = secrets.token_urlsafe(32)
+            self.store.set(session.sid, {"saved_at": time.time(), "data": self.serializer.dumps(dict(session))},
+                           self.ttl)
+        except (OSError, SessionStoreError) as e:
+            print("could not save the session: %s" % e, file=sys.stderr)
+            return
+        if new_sid or (session.permanent and app.config["SESSION_REFRESH_EACH_REQUEST"]):
+            response.set_cookie(name, self._get_signer(app).sign(session.sid.encode("ascii")).decode("ascii"),
+                                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    """ Answers the GET, SET (with EX), DEL and PING commands of the Redis protocol, for local tests only. """
+    def handle(self):
+        while True:
+            try:
+                command = _read_reply(self.rfile)
+            except (ConnectionError, SessionStoreError, ValueError):
+                return
+            name = command[0].upper() if command else b""
+            with self.server.lock:
+                now = time.time()
+                if name == b"GET":
+                    value, expires = self.server.data.get(command[1], (None, 0))
+                    reply = b"$%d\r\n%s\r\n" % (len(value), value) if value is not None and expires > now else b"$-1\r\n"
+                elif name == b"SET":
+                    ttl = int(command[4]) if len(command) >= 5 and command[3].upper() == b"EX" else 10 ** 9
+                    self.server.data[command[1]] = (command[2], now + ttl)
+                    reply = b"+OK\r\n"
+                elif name == b"DEL":
+                    reply = b":%d\r\n" % sum(self.server.data.pop(key, None) is not None for key in command[1:])
+                elif name == b"PING":
+                    reply = b"+PONG\r\n"
+                else:
+                    reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python3 -m syllabus.utils.sessions port", file=sys.stderr)
+        sys.exit(1)
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("localhost", int(sys.argv[1])), StandInHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.lock = threading.Lock()
+    print("Session store stand-in listening on localhost:%s" % sys.argv[1], file=sys.stderr)
+    server.serve_forever()
@@ -1,4 +1,5 @@
 import os
+import shutil
 import time
 from abc import ABC, abstractmethod
 from collections import OrderedDict
@@ -12,6 +13,10 @@ from syllabus.utils.yaml_ordered_dict import OrderedDictYAMLLoader
 
 from syllabus import get_pages_path
 
+# version of the templates compiled in the .cached directories, to be incremented when the directives change their
+# output so that the pages compiled by a previous version are discarded
+compiled_format_version = "2"
+
 
 class ContentNotFoundError(Exception):
     pass
@@ -117,10 +122,25 @@ class TableOfContent(object):
         toc_file = toc_file if toc_file is not None else safe_join(self.toc_path, "toc.yaml")
         self._cached_path = os.path.join(self.toc_path, ".cached")
         self._print_cached_path = os.path.join(self.toc_path, ".print_cached")
+        self._discard_outdated_cache()
         with open(toc_file, "r") as f:
             toc_dict = yaml.load(f, Loader=OrderedDictYAMLLoader)
             self._init_from_dict(toc_dict, ignore_not_found)
 
+    def _discard_outdated_cache(self):
+        for path in [self._cached_path, self._print_cached_path]:
+            version_path = os.path.join(path, ".format_version")
+            try:
+                with open(version_path, "r") as f:
+                    if f.read().strip() == compiled_format_version:
+                        continue
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path, exist_ok=True)
+            with open(version_path, "w") as f:
+                f.write(compiled_format_version)
+
     def _init_from_dict(self, toc_dict: OrderedDict, ignore_not_found=False):
         self._ignored_list = []
         self.toc_dict = toc_dict
@@ -0,0 +1,131 @@
+"""
+Bulk import of local users from a CSV file, e.g. an export of the registrar. The file must have a header containing
+at least an "email" column, and optionally "full_name", "password" and "right" (admin or teacher) columns.
+The users without password get a password reset link, as the default admin user. From the command line:
+
+    python3 -m syllabus.utils.user_import students.csv > reset_links.csv
+"""
+
+import binascii
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import insert
+
+import syllabus
+from syllabus.database import db_session
+from syllabus.models.user import User, hash_password_func
+from syllabus.utils.pages import invalidate_user_right
+from syllabus.utils.password_hashing import get_password_hasher
+
+# number of e-mails looked up at once, below the SQLite limit on the number of query parameters
+lookup_batch_size = 500
+insert_batch_size = 1000
+
+
+def parse_users_csv(stream):
+    """ :return: the list of the rows of the CSV file read from the given text stream, as dicts """
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None or "email" not in [name.strip() for name in reader.fieldnames]:
+        raise ValueError("the CSV file must have a header with an email column")
+    return [{(key or "").strip(): (value or "").strip() for key, value in row.items()} for row in reader]
+
+
+def get_existing_emails(emails):
+    """ :return: the set of the given e-mails that are already used by a user """
+    existing = set()
+    emails = list(emails)
+    for i in range(0, len(emails), lookup_batch_size):
+        existing.update(email for email, in db_session.query(User.email)
+                        .filter(User.email.in_(emails[i:i + lookup_batch_size])))
+    return existing
+
+
+def _hash_passwords(users_to_hash, processes):
+    global_salt = syllabus.get_config().get('password_salt', None)
+    n_iterations = syllabus.get_config().get('password_hash_iterations', 100000)
+    args = ([u["email"] for u in users_to_hash], [u["password"] for u in users_to_hash],
+            [global_salt] * len(users_to_hash), [n_iterations] * len(users_to_hash))
+    if global_salt is None or processes == 0 or len(users_to_hash) < 2:
+        return list(map(hash_password_func, *args))
+    if processes is None:
+        # in a worker of the syllabus, the pool of the logins is reused so that an upload cannot fork another one
+        return get_password_hasher().hash_many(args[0], args[1], global_salt, n_iterations)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(hash_password_func, *args, chunksize=max(1, len(users_to_hash) // (processes * 4))))
+
+
+def import_users(rows, processes=None):
+    """
+    Creates the activated users described by the given rows, in a single transaction. The passwords are hashed in
+    parallel by a pool of processes.
+    :param processes: the number of processes of a pool dedicated to this import, e.g. from the command line. By
+    default, the passwords are hashed by the shared pool of the password hasher of this process
+    :raises HashingOverloaded: if the shared pool is too busy
+    :return: a dict containing the number of imported users, the lists of the existing and invalid e-mails, and the
+    password reset secret of each imported user without password
+    """
+    report = {"imported": 0, "existing": [], "invalid": [], "change_password_urls": {}}
+    users = {}
+    for row in rows:
+        email = row.get("email", "")
+        right = row.get("right", "") or None
+        if "@" not in email or len(email) > 120 or email in users or right not in [None, "admin", "teacher"]:
+            report["invalid"].append(email)
+            continue
+        users[email] = {"email": email, "full_name": row.get("full_name", "") or None,
+                        "password": row.get("password", "") or None, "right": right}
+    existing = get_existing_emails(users.keys())
+    report["existing"] = sorted(existing)
+    users = [u for email, u in users.items() if email not in existing]
+
+    users_to_hash = [u for u in users if u["password"] is not None]
+    hashes = _hash_passwords(users_to_hash, processes)
+    for u, password_hash in zip(users_to_hash, hashes):
+        u["hash_password"] = password_hash
+    for u in users:
+        if u["password"] is None:
+            u["hash_password"] = None
+            u["change_password_url"] = binascii.hexlify(os.urandom(20)).decode()
+            report["change_password_urls"][u["email"]] = u["change_password_url"]
+
+    try:
+        for i in range(0, len(users), insert_batch_size):
+            db_session.execute(insert(User.__table__), [{"email": u["email"], "full_name": u["full_name"],
+                                                         "hash_password": u["hash_password"],
+                                                         "change_password_url": u.get("change_password_url", None),
+                                                         "right": u["right"], "activated": True}
+                                                        for u in users[i:i + insert_batch_size]])
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    for u in users:
+        if u["right"] is not None:
+            invalidate_user_right(u["email"])
+    report["imported"] = len(users)
+    return report
+
+
+def write_reset_links(report, stream, base_url=""):
+    """ Writes the password reset links of the imported users without password as CSV in the given text stream. """
+    writer = csv.writer(stream)
+    writer.writerow(["email", "reset_password_url"])
+    for email, secret in sorted(report["change_password_urls"].items()):
+        writer.writerow([email, "%s/resetpassword/%s" % (base_url.rstrip("/"), secret)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python3 -m syllabus.utils.user_import users.csv", file=sys.stderr)
+        sys.exit(1)
+    with open(sys.argv[1], newline="", encoding="utf-8") as f:
+        import_report = import_users(parse_users_csv(f), processes=os.cpu_count() or 1)
+    print("%d users imported, %d already existing, %d invalid rows" % (import_report["imported"],
+                                                                        len(import_report["existing"]),
+                                                                        len(import_report["invalid"])), file=sys.stderr)
+    for invalid_email in import_report["invalid"]:
+        print("invalid row: %s" % invalid_email, file=sys.stderr)
+    write_reset_links(import_report, sys.stdout)
@@ -0,0 +1,121 @@
+"""
+Warmup of the workers. It loads what the first requests of a new worker would otherwise load: the configuration, the
+TOC and the compiled pages of each course, the Sphinx applications, the Jinja templates of the application and the
+fingerprints of the assets.
+
+When it runs before the workers are forked (gunicorn --preload with warmup.on_import, or the syllabus.wsgi import
+script), the loaded structures are shared copy-on-write by the workers. Otherwise, the first call to /ready warms the
+worker up, so that a load balancer using /ready as health check only sends traffic to warm workers.
+"""
+
+import os
+import sys
+import threading
+import time
+
+from flask import g
+
+import syllabus
+from syllabus.database import db_session, engine
+from syllabus.utils.assets import get_asset_fingerprint
+
+
+def get_warmup_config():
+    warmup_config = syllabus.get_config().get("warmup", None) or {}
+    return {
+        "on_import": warmup_config.get("on_import", False),
+        "compile_pages": warmup_config.get("compile_pages", True),
+    }
+
+
+def _fingerprint_directory(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            get_asset_fingerprint(os.path.join(root, name))
+
+
+def warmup_course(app, course, compile_pages=True):
+    """ Loads the TOC, the compiled pages and the assets of a course, or its Sphinx application. """
+    # imported here as the sync module imports the heavy part of the pages rendering
+    from syllabus.utils.git_sync import rewarm
+    if syllabus.get_config()["courses"][course].get("sphinx"):
+        syllabus.get_sphinx_build(course)
+        return {"sphinx": True}
+    with app.app_context():
+        g.course = course
+        toc = syllabus.get_toc(course)
+        pages_path = syllabus.get_pages_path(course)
+        contents = [toc.index] + toc.ordered_content_list
+    if compile_pages:
+        rewarm(app, course, contents, pages_path=pages_path)
+    for root, dirs, files in os.walk(pages_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        if os.path.basename(root) == "assets":
+            _fingerprint_directory(root)
+            dirs[:] = []
+    return {"contents": len(contents)}
+
+
+def warmup(app, compile_pages=None, before_fork=False):
+    """
+    Warms every course up.
+    :param before_fork: set to True when warming up at import time, before the workers are forked and before any
+    request is served. The database connections are then released so that they are not shared with the workers.
+    They are kept otherwise, as the requests being served rely on them.
+    :return: the warm state of this process, as returned by get_warm_state
+    """
+    if compile_pages is None:
+        compile_pages = get_warmup_config()["compile_pages"]
+    with warmup.lock:
+        start = time.monotonic()
+        courses = {}
+        for course in syllabus.get_courses():
+            course_start = time.monotonic()
+            try:
+                courses[course] = warmup_course(app, course, compile_pages)
+                courses[course]["ready"] = True
+            except Exception as e:
+                print("could not warm the course %s up: %s" % (course, e), file=sys.stderr)
+                courses[course] = {"ready": False, "error": str(e)}
+            courses[course]["duration"] = time.monotonic() - course_start
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        _fingerprint_directory(app.static_folder)
+        if before_fork:
+            db_session.remove()
+            engine.dispose()
+        warmup.state = {"pid": os.getpid(), "duration": time.monotonic() - start, "courses": courses}
+    return get_warm_state()
+
+
+warmup.lock = threading.RLock()
+warmup.state = None
+
+
+def ensure_warm(app, before_fork=False):
+    """
+    Warms this process up if it has not been done yet, see warmup for before_fork.
+    :return: the warm state, None if a warmup is in progress
+    """
+    if warmup.state is None:
+        if not warmup.lock.acquire(blocking=False):
+            return None
+        try:
+            if warmup.state is None:
+                warmup(app, before_fork=before_fork)
+        finally:
+            warmup.lock.release()
+    return get_warm_state()
+
+
+def get_warm_state():
+    """
+    :return: None if this process has not been warmed up, or a dict telling if every course is ready, the state of each
+    course and if the warmup happened before this worker was forked
+    """
+    state = warmup.state
+    if state is None:
+        return None
+    return {"ready": all(course_state["ready"] for course_state in state["courses"].values()),
+            "before_fork": state["pid"] != os.getpid(), "duration": state["duration"], "courses": state["courses"]}
@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+import yaml
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def client():
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(root, "configuration_default.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["sessions_secret_key"] = "test"
+    config["shared_cache_path"] = os.path.join(directory, "cache.sqlite")
+    config["courses"] = {"default": config["courses"]["default"]}
+    with open(os.path.join(directory, "configuration.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    os.environ["SYLLABUS_CONFIG_PATH"] = directory
+    os.environ["SYLLABUS_DATABASE_URI"] = "sqlite:///%s" % os.path.join(directory, "database.sqlite")
+    from syllabus.database import init_db
+    import syllabus.inginious_syllabus
+    init_db()
+    yield syllabus.inginious_syllabus.app.test_client()
+    shutil.rmtree(directory)
+
+
+def test_cheat_sheet_renders_outside_of_a_course(client):
+    # the images of the cheat sheet are resolved without a course set by the request handler
+    with client.session_transaction() as session:
+        session["user"] = {"email": "admin@localhost"}
+    response = client.get("/preview/cheat_sheet")
+    assert response.status_code == 200
+    assert b'id="cheat_sheet"' in response.data